@@ -2,12 +2,16 @@
 import sys
 sys.path.append('/opt/scw/NeuroTK-Dash')
 
-from ultralytics import YOLO
 from histomicstk.cli.utils import CLIArgumentParser  # for CLI implementation
-import json
+import numpy as np
+from pathlib import Path
+from os.path import dirname
+import traceback
 
 from neurotk.yolo import wsi_inference
-from neurotk.yolo.utils import get_devices
+from neurotk.yolo.utils import get_devices, load_yolo
+from neurotk.utils import read_manifest, slide_subdir
+from neurotk.annotations import box_elements, write_annotation
 
 # from argparse import ArgumentParser  # for developing outside CLI implementation
 
@@ -31,31 +35,14 @@ from neurotk.yolo.utils import get_devices
 #     return parser.parse_args()
 
 
-def main(args):
-    """Detect nuclei with pre-trained YOLO model and inference results back
-    to the DSA as annotations.
+def analyze_slide(args, in_file, out_file, model, device):
+    """Detect nuclei in an image with a loaded YOLO model and save them as an
+    annotation file.
     
     """
-    # Get the device ids.
-    if args.device == 'cuda':
-        # Get the number of devices.
-        device = get_devices()[0]
-        
-        if device is None:
-            device = 'cpu'
-    elif args.device != 'cpu':
-        device = 'cpu'
-    else:
-        device = 'cpu'
-    
-    # Load model.
-    print('Trying to load YOLO weights')
-    model = YOLO('/opt/scw/cli/DAPINucleiDetection/best.pt')
-    print("YOLO weights loaded.")
-    
     print('Inferencing....')
     pred_df = wsi_inference(
-        args.in_file, 
+        in_file, 
         model,
         frame=args.frame,
         device=device,
@@ -63,43 +50,102 @@ def main(args):
         iou_thr=args.iou_thr,
         conf_thr=args.conf_thr,
         fill=(0, 0, 0),
-        contained_thr=args.contained_thr
+        contained_thr=args.contained_thr,
+        workers=args.workers,
+        checkpoint=slide_subdir(args.checkpoint_dir, in_file) if \
+            args.checkpoint_dir else None,
+        shards=args.shards,
+        blank_std_thr=args.blank_std_thr or None,
+        cache_dir=args.cache_dir or None,
+        nms_method=args.nms_method,
+        agnostic_nms=args.agnostic_nms == 'yes'
     )
     print('Inference complete!')
     
     # Push results to DSA as annotations.
-    elements = []
-
-    for _, r in pred_df.iterrows():
-        tile_w, tile_h = r.x2 - r.x1, r.y2 - r.y1
-        tile_center = [(r.x2 + r.x1) / 2, (r.y2 + r.y1) / 2, 0]
-
-        elements.append({
-            'lineColor': 'rgb(0,255,0)',
-            'lineWidth': 2,
-            'rotation': 0,
-            'type': 'rectangle',
-            'center': tile_center,
-            'width': tile_w,
-            'height': tile_h,
-            'label': {'value': 'nucleus'},
-            'group': 'nucleus'
-        })
+    elements = box_elements(
+        pred_df[['x1', 'y1', 'x2', 'y2']].to_numpy(), 
+        np.zeros(len(pred_df), dtype=int), names=('nucleus',), 
+        colors=('rgb(0,255,0)',)
+    )
         
     # Save the annotation as an anot file.
     ann_doc = {
-        "name": args.docname, "elements": elements, 
-        "description": ""
+        "name": args.docname, "elements": [], 
+        "description": "",
+        "attributes": {
+            # Parameters of the image processed, not of the batch's input.
+            "params": dict(
+                vars(args), in_file=in_file, tissueAnnotationFile=out_file
+            ),
+            "cli": Path(__file__).stem,
+        }
     }
     
     print('Annotation document setup')
     
-    with open(args.tissueAnnotationFile, 'w') as fh:
-        json.dump(ann_doc, fh, separators=(',', ':'), sort_keys=False)
+    # Elements are streamed to the file in chunks.
+    write_annotation(out_file, ann_doc, elements=elements)
         
     print('done')
 
 
+def main(args):
+    """Detect nuclei with pre-trained YOLO model and inference results back
+    to the DSA as annotations. Images in the manifest are processed with the
+    same loaded model.
+    
+    """
+    # Get the device ids.
+    if args.device == 'cuda':
+        # Get the number of devices.
+        device = get_devices()[0]
+        
+        if device is None:
+            device = 'cpu'
+    elif args.device != 'cpu':
+        device = 'cpu'
+    else:
+        device = 'cpu'
+    
+    # Load model, once for all the images.
+    print('Trying to load YOLO weights')
+    model = load_yolo('/opt/scw/cli/DAPINucleiDetection/best.pt')
+    print("YOLO weights loaded.")
+    
+    images = [(args.in_file, args.tissueAnnotationFile)]
+    
+    if args.manifest:
+        images += read_manifest(
+            args.manifest, 
+            out_dir=args.output_dir or dirname(args.tissueAnnotationFile),
+            reserved=[args.tissueAnnotationFile]
+        )
+        
+    failed = []
+        
+    for i, (in_file, out_file) in enumerate(images):
+        print(f'Image {i + 1} of {len(images)}: {in_file}')
+        
+        try:
+            analyze_slide(args, in_file, out_file, model, device)
+        except Exception:
+            # A failed image does not stop the rest of the batch.
+            print(f'Failed to process {in_file}:')
+            traceback.print_exc()
+            failed.append(i)
+            
+    if failed:
+        print(f'Failed to process {len(failed)} of {len(images)} images:')
+        
+        for i in failed:
+            print(f'  {images[i][0]}')
+            
+    if 0 in failed:
+        # The job's own output annotation file was not written.
+        raise RuntimeError(f'Failed to process {args.in_file}.')
+
+
 if __name__ == "__main__":
     # CLI parameters are read from accompanying XML file.
     main(CLIArgumentParser().parse_args())
@@ -2,21 +2,28 @@
 import sys
 sys.path.append('/opt/scw/NeuroTK-Dash')
 
-from ultralytics import YOLO
 from histomicstk.cli.utils import CLIArgumentParser
 # from argparse import ArgumentParser
-import json
-import cv2 as cv
 import large_image
 import numpy as np
 from pathlib import Path
-from shapely.geometry import Point, Polygon
+from os.path import dirname
+import traceback
 from pandas import DataFrame
-from libpysal import weights
-import networkx as nx
+from shapely.geometry import box
 
 from neurotk.yolo import wsi_inference
-from neurotk.yolo.utils import get_devices
+from neurotk.yolo.utils import get_devices, load_yolo
+from neurotk.utils import (
+    box_centroids, box_centroid_points, read_manifest, slide_subdir
+)
+from neurotk.region import (
+    region_mask, region_polygons, polygons_geometry, is_whole_region
+)
+from neurotk.annotations import box_elements, write_annotation
+from neurotk.spatial import (
+    densest_window, clustering_coefficients, spatial_statistics
+)
 
 
 # def parse_args():
@@ -45,26 +52,12 @@ from neurotk.yolo.utils import get_devices
 #     return parser.parse_args()
 
 
-def corners_to_polygon(x1: int, y1: int, x2: int, y2: int) -> Polygon:
-    """Return a Polygon from shapely with the box coordinates given the top left and bottom right corners of a 
-    rectangle (can be rotated).
-    
-    Args:
-        x1, y1, x2, y2: Coordinates of the top left corner (point 1) and the bottom right corner (point 2) of a box.
-        
-    Returns:
-        Shapely polygon object of the box.
-        
-    """
-    return Polygon([(x1, y1), (x2, y1), (x2, y2), (x1, y2)])
-
-
-def main(args):
-    """Detect nuclei with pre-trained YOLO model and inference results back
-    to the DSA as annotations.
+def analyze_slide(args, in_file, out_file, model, device):
+    """Detect NFTs in a slide with a loaded YOLO model and save the results
+    and stats as an annotation file.
     
     """  
-    ts = large_image.getTileSource(args.in_file).getMetadata()
+    ts = large_image.getTileSource(in_file).getMetadata()
         
     # The FOV is 4mm^2, and since it is square it is 2mm^2 in each side.
     # Note I specifically calculate these for width and height separately,
@@ -83,58 +76,39 @@ def main(args):
     # Multiply for full resolution -> low res. mask scale.
     fr_to_mask = args.mask_mag / ts['magnification']
     
-    mask = np.zeros(
-        (int(ts['sizeY'] * fr_to_mask), int(ts['sizeX'] * fr_to_mask)),
-        dtype=np.uint8
-    )
+    # Shape of a mask of the whole image.
+    h = int(ts['sizeY'] * fr_to_mask)
+    w = int(ts['sizeX'] * fr_to_mask)
     
     """A region can be one or multiple polygons containing the region the 
     analysis. For this workflow this region must be converted into a binary
-    mask."""
+    mask, cropped to the region's bounding box."""
     print('This is the region info:')
     print('type', type(args.region))
     print(args.region)
     
-    if len(args.region) == 4:
-        if args.region == [-1, -1, -1, -1]:
-            # This signals the whole region!
-            mask[:, :] = 255
-        else:
-            left, top, width, height = args.region
-            
-            left = int(left * fr_to_mask)
-            top = int(top * fr_to_mask)
-            width = int(width * fr_to_mask)
-            height = int(height * fr_to_mask)
-    
-            mask[top:top+height, left:left+width] = 255
-    else:
-        # This is multiple objects or a polygon style region.
-        # Regions are separated by two -1, -1 values.
-        contours = []
-        contour = []
-
-        for coord in args.region:
-            if coord < 0:
-                if len(contour):
-                    contours.append(np.reshape(contour, (-1, 2)))
-                    contour = []
-            else:
-                contour.append(int(coord * fr_to_mask))
-
-        if len(contour):
-            contours.append(np.reshape(contour, (-1, 2)))
-            
-        mask = cv.drawContours(mask, contours, -1, 255, cv.FILLED)
+    mask, mask_offset = region_mask(args.region, fr_to_mask, (h, w))
     
     # Convert to scale factor in mm^2
-    h, w = mask.shape[:2]
     sf = (ts['sizeY'] / h) * (ts['sizeX'] / w)
     sf *= ts['mm_x'] * ts['mm_y']
 
     # Denominator is the mm^2 area that contains tissue.
     den = np.count_nonzero(mask) * sf
     
+    if args.exact_region == 'yes' and not is_whole_region(args.region):
+        # Select and mask tiles with the region polygons instead.
+        polygons = region_polygons(args.region)
+        mask, mask_offset = None, (0, 0)
+        
+        geometry = polygons_geometry(polygons).intersection(
+            box(0, 0, ts['sizeX'], ts['sizeY'])
+        )
+        
+        den = geometry.area * ts['mm_x'] * ts['mm_y']
+    else:
+        polygons = None
+    
     # from shapely import wkt
     # from geopandas import GeoDataFrame
     # from pandas import read_csv
@@ -143,26 +117,9 @@ def main(args):
     # pred_df['geometry'] = pred_df['geometry'].apply(wkt.loads)
     # pred_df = GeoDataFrame(pred_df)
     
-    # Get the device ids.
-    if args.device == 'cuda':
-        # Get the number of devices.
-        device = get_devices()[0]
-        
-        if device is None:
-            device = 'cpu'
-    elif args.device != 'cpu':
-        device = 'cpu'
-    else:
-        device = 'cpu'
-    
-    # Load model.
-    print('Trying to load YOLO weights')
-    model = YOLO('/opt/scw/cli/NFTDetection/best.pt')
-    print("YOLO weights loaded.")
-    
     print('Inferencing....')
     pred_df = wsi_inference(
-        args.in_file, 
+        in_file, 
         model,
         device=device,
         max_det=args.max_det,
@@ -172,7 +129,18 @@ def main(args):
         contained_thr=args.contained_thr,
         mask_thr=args.mask_thr,
         mask=mask,
-        mag=args.mag
+        mask_offset=mask_offset,
+        mask_scale=fr_to_mask,
+        polygons=polygons,
+        mag=args.mag,
+        workers=args.workers,
+        checkpoint=slide_subdir(args.checkpoint_dir, in_file) if \
+            args.checkpoint_dir else None,
+        shards=args.shards,
+        blank_std_thr=args.blank_std_thr or None,
+        cache_dir=args.cache_dir or None,
+        nms_method=args.nms_method,
+        agnostic_nms=args.agnostic_nms == 'yes'
     )
     
     # pred_df.to_csv('temp.csv', index=False)
@@ -191,41 +159,27 @@ def main(args):
         
         # Find the FOV with the highest density of each type NFT.
         # Convert the geomery to a point.
-        for i, r in pred_df.iterrows():
-            pred_df.loc[i, 'geometry'] = Point(
-                (r.x1 + r.x2) / 2, (r.y1 + r.y2) / 2
-            )
+        boxes = pred_df[['x1', 'y1', 'x2', 'y2']].to_numpy()
+        
+        pred_df['geometry'] = box_centroid_points(boxes)
 
         # Check FOVs with some overlap to catch highest FOV.
-        xys = []
-
-        for x in range(0, ts['sizeX'], int(fov_w / 2)):
-            for y in range(0, ts['sizeY'], int(fov_h / 2)):
-                xys.append([x, y])
-
+        centroids = box_centroids(boxes)
+        
         # loop for each class
         highest_fov = {0: None, 1: None}
 
         for cls in (0, 1):
-            highest_within = 0
+            cls_idx = np.flatnonzero(pred_df['label'].to_numpy() == cls)
             
-            for xy in xys:
-                x, y = xy
-
-                # Create the FOV polygon.
-                x1, y1, x2, y2 = x, y, x + fov_w, y + fov_h
-
-                fov = corners_to_polygon(x1, y1, x2, y2)
-
-                # Calculate how many points are in the FOV
-                within = pred_df[pred_df.within(fov)]
-                within = within[within['label'] == cls]
-
-                if len(within) > highest_within:
-                    highest_fov[cls] = within.copy()
-                    highest_within = len(within)
-                    
-            if highest_fov[cls] is None:
+            fov_xy, within = densest_window(
+                centroids[cls_idx], fov_w, fov_h, int(fov_w / 2), 
+                int(fov_h / 2), (ts['sizeX'], ts['sizeY'])
+            )
+            
+            if fov_xy is not None:
+                highest_fov[cls] = pred_df.iloc[cls_idx[within]].copy()
+            else:
                 highest_fov[cls] = DataFrame(
                     [],
                     columns=['label', 'x1', 'y1', 'x2', 'y2', 'geometry']
@@ -236,29 +190,17 @@ def main(args):
         
         # Calculate average clustering cofficient for different radii in the highest FOV!.
         for cls in (0, 1):
-            coordinates = []
-            
             cls_label = 'iNFT' if cls else 'Pre-NFT'
 
-            for _, r in highest_fov[cls].iterrows():
-                coordinates.append([(r.x1 + r.x2) / 2, (r.y1 + r.y2) / 2])
+            coordinates = box_centroids(
+                highest_fov[cls][['x1', 'y1', 'x2', 'y2']].to_numpy()
+            )
             
-            coordinates = np.array(coordinates)
+            # Neighbours are found once for the largest radius.
+            coefs = clustering_coefficients(coordinates, px_radii)
             
-            if len(coordinates):
-                for i, r in enumerate(px_radii):
-                    # https://networkx.org/documentation/stable/auto_examples/geospatial/plot_points.html
-                    dist = weights.DistanceBand.from_array(
-                        coordinates, threshold=r, silence_warnings=True
-                    )
-
-                    dist_graph = dist.to_networkx()
-
-                    # Calculate average clustering of the graph.
-                    stats[f'{cls_label} clustering Coef (r={radii[i]})'] = \
-                        float(nx.average_clustering(dist_graph))
-            else:
-                stats[f'{cls_label} clustering Coef (r={radii[i]})'] = 0
+            for r, coef in zip(radii, coefs):
+                stats[f'{cls_label} clustering Coef (r={r})'] = coef
     else:
         stats = {
             'iNFT_count': 0,
@@ -273,34 +215,58 @@ def main(args):
             for r in radii:
                 stats[f'{cls} clustering Coef (r={r})'] = 0
     
+    if args.slide_stats == 'yes':
+        # Spatial statistics over all the detections of each class, reported
+        # in microns.
+        um_per_px = ts['mm_x'] * 1000
+        area = den / (ts['mm_x'] * ts['mm_y'])  # tissue area in pixels
+        
+        for cls in (0, 1):
+            cls_label = 'iNFT' if cls else 'Pre-NFT'
+            
+            cls_df = pred_df[pred_df['label'] == cls]
+            
+            coordinates = box_centroids(
+                cls_df[['x1', 'y1', 'x2', 'y2']].to_numpy()
+            )
+            
+            slide_stats = spatial_statistics(coordinates, px_radii, area)
+            
+            for k, r in enumerate(radii):
+                stats[f'{cls_label} slide clustering Coef (r={r})'] = \
+                    slide_stats['clustering'][k]
+                stats[f'{cls_label} Ripley K (r={r})'] = \
+                    slide_stats['ripley_k'][k] * um_per_px ** 2
+                stats[f'{cls_label} Ripley L (r={r})'] = \
+                    slide_stats['ripley_l'][k] * um_per_px
+                
+            nn_dists = slide_stats['nn_distances'] * um_per_px
+            
+            if len(nn_dists):
+                stats[f'{cls_label} NN distance mean'] = float(nn_dists.mean())
+                stats[f'{cls_label} NN distance median'] = \
+                    float(np.median(nn_dists))
+                stats[f'{cls_label} NN distance std'] = float(nn_dists.std())
+            else:
+                for stat in ('mean', 'median', 'std'):
+                    stats[f'{cls_label} NN distance {stat}'] = 0
+    
     # Push results to DSA as annotations.
-    elements = []
-
-    for _, r in pred_df.iterrows():
-        tile_w, tile_h = r.x2 - r.x1, r.y2 - r.y1
-        tile_center = [(r.x2 + r.x1) / 2, (r.y2 + r.y1) / 2, 0]
-        label = int(r['label'])
-        color = 'rgb(255,0,0)' if label else 'rgb(0,0,255)'
-        label = 'iNFT' if label else 'Pre-NFT'
-
-        elements.append({
-            'lineColor': color,
-            'lineWidth': 2,
-            'rotation': 0,
-            'type': 'rectangle',
-            'center': tile_center,
-            'width': tile_w,
-            'height': tile_h,
-            'label': {'value': label},
-            'group': label
-        })
+    elements = box_elements(
+        pred_df[['x1', 'y1', 'x2', 'y2']].to_numpy(), 
+        pred_df['label'].to_numpy(), names=('Pre-NFT', 'iNFT'),
+        colors=('rgb(0,0,255)', 'rgb(255,0,0)')
+    )
         
     # Save the annotation as an anot file.
     ann_doc = {
-        "name": args.docname, "elements": elements, 
+        "name": args.docname, "elements": [], 
         "description": "",
         "attributes": {
-            "params": vars(args),
+            # Parameters of the slide processed, not of the batch's input.
+            "params": dict(
+                vars(args), in_file=in_file, tissueAnnotationFile=out_file
+            ),
             "stats": stats,
             "cli": Path(__file__).stem,
         }
@@ -308,12 +274,68 @@ def main(args):
     
     print('Annotation document setup')
     
-    with open(args.tissueAnnotationFile, 'w') as fh:
-        json.dump(ann_doc, fh, separators=(',', ':'), sort_keys=False)
+    # Elements are streamed to the file in chunks.
+    write_annotation(out_file, ann_doc, elements=elements)
         
     print('done')
 
 
+def main(args):
+    """Detect NFTs with pre-trained YOLO model and inference results back
+    to the DSA as annotations. Slides in the manifest are processed with the
+    same loaded model.
+    
+    """
+    # Get the device ids.
+    if args.device == 'cuda':
+        # Get the number of devices.
+        device = get_devices()[0]
+        
+        if device is None:
+            device = 'cpu'
+    elif args.device != 'cpu':
+        device = 'cpu'
+    else:
+        device = 'cpu'
+    
+    # Load model, once for all the slides.
+    print('Trying to load YOLO weights')
+    model = load_yolo('/opt/scw/cli/NFTDetection/best.pt')
+    print("YOLO weights loaded.")
+    
+    slides = [(args.in_file, args.tissueAnnotationFile)]
+    
+    if args.manifest:
+        slides += read_manifest(
+            args.manifest, 
+            out_dir=args.output_dir or dirname(args.tissueAnnotationFile),
+            reserved=[args.tissueAnnotationFile]
+        )
+        
+    failed = []
+        
+    for i, (in_file, out_file) in enumerate(slides):
+        print(f'Slide {i + 1} of {len(slides)}: {in_file}')
+        
+        try:
+            analyze_slide(args, in_file, out_file, model, device)
+        except Exception:
+            # A failed slide does not stop the rest of the batch.
+            print(f'Failed to process {in_file}:')
+            traceback.print_exc()
+            failed.append(i)
+            
+    if failed:
+        print(f'Failed to process {len(failed)} of {len(slides)} slides:')
+        
+        for i in failed:
+            print(f'  {slides[i][0]}')
+            
+    if 0 in failed:
+        # The job's own output annotation file was not written.
+        raise RuntimeError(f'Failed to process {args.in_file}.')
+
+
 if __name__ == "__main__":
     # CLI parameters are read from accompanying XML file.
     main(CLIArgumentParser().parse_args())
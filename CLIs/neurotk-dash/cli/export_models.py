@@ -0,0 +1,38 @@
+"""Export the tissue segmentation models to TorchScript and ONNX when the
+docker image is built, so CLI jobs load the exports directly instead of
+exporting them in every fresh job container. The exports are for the
+default thumbnail size of each CLI, and the build fails if an export does
+not match its PyTorch model.
+
+"""
+import sys
+sys.path.append('/opt/scw/NeuroTK-Dash')
+
+import xml.etree.ElementTree as ET
+
+from neurotk.torch.runtime import load_weights, export_runtime
+
+from TissueSegmentation import TissueSegmentation
+from TissueSegmentationV2 import TissueSegmentationV2
+
+
+def default_size(xml_fp):
+    """Default of the size parameter in a CLI's XML."""
+    for param in ET.parse(xml_fp).getroot().iter('integer'):
+        if param.findtext('name') == 'size':
+            return int(param.findtext('default'))
+        
+    raise ValueError(f'{xml_fp} has no size parameter.')
+
+
+def main():
+    for cli in (TissueSegmentation, TissueSegmentationV2):
+        size = default_size(cli.__file__.replace('.py', '.xml'))
+        model = load_weights(cli.build_model, cli.WEIGHTS)
+        
+        for runtime in ('torchscript', 'onnx'):
+            export_runtime(model, cli.WEIGHTS, runtime, size)
+            
+            
+if __name__ == "__main__":
+    main()
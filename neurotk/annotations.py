@@ -0,0 +1,188 @@
+"""Build and write DSA annotation documents."""
+from typing import Iterable, Iterator, List, Optional, Sequence, Union
+import numpy as np
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _dumps(obj, use_orjson: bool = True) -> bytes:
+    """Compact JSON encoding, with orjson if available."""
+    if use_orjson and orjson is not None:
+        return orjson.dumps(obj)
+
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+def box_elements(
+    boxes: np.ndarray, labels: np.ndarray, names: Sequence[str],
+    colors: Sequence[str], line_width: int = 2, chunk_size: int = 10000
+) -> Iterator[List[dict]]:
+    """Create rectangle annotation elements from boxes, in chunks. The
+    centers, widths and heights are calculated with NumPy for all the boxes
+    at once.
+
+    Args:
+        boxes (numpy.ndarray): [N, 4] boxes in (x1, y1, x2, y2) format.
+        labels (numpy.ndarray): [N] integer labels of the boxes, indices of
+            names and colors.
+        names (Sequence[str]): Name of each label, used as the label value
+            and group of the elements.
+        colors (Sequence[str]): Line color of each label, e.g. 'rgb(255,0,0)'.
+        line_width (int): Line width of the elements.
+        chunk_size (int): Number of elements in each chunk.
+
+    Returns:
+        Iterator of lists of element dictionaries.
+
+    """
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    labels = np.asarray(labels, dtype=int)
+
+    # Python scalars, so the elements are JSON serializable.
+    cx = ((boxes[:, 0] + boxes[:, 2]) / 2).tolist()
+    cy = ((boxes[:, 1] + boxes[:, 3]) / 2).tolist()
+    widths = (boxes[:, 2] - boxes[:, 0]).tolist()
+    heights = (boxes[:, 3] - boxes[:, 1]).tolist()
+    labels = labels.tolist()
+
+    for start in range(0, len(labels), chunk_size):
+        end = start + chunk_size
+
+        yield [
+            {
+                'lineColor': colors[label],
+                'lineWidth': line_width,
+                'rotation': 0,
+                'type': 'rectangle',
+                'center': [x, y, 0],
+                'width': w,
+                'height': h,
+                'label': {'value': names[label]},
+                'group': names[label]
+            }
+            for x, y, w, h, label in zip(
+                cx[start:end], cy[start:end], widths[start:end],
+                heights[start:end], labels[start:end]
+            )
+        ]
+
+
+def contour_elements(
+    contours: Sequence[np.ndarray], label: str, line_color: str,
+    scale: Union[float, Sequence[float]] = 1, line_width: float = 2,
+    min_points: int = 4
+) -> List[dict]:
+    """Create closed polyline annotation elements from OpenCV contours. The
+    points of all the contours are scaled, truncated to integers and padded
+    with a z coordinate of 0 with NumPy at once.
+
+    Args:
+        contours (Sequence[numpy.ndarray]): OpenCV contours, each of shape
+            (num_points, 1, 2) with x, y order.
+        label (str): Label value and group of the elements.
+        line_color (str): Line color of the elements, e.g. 'rgb(0,179,60)'.
+        scale (float | Sequence[float]): Multiplicative factor from contour
+            to annotation coordinates, or an x and a y factor.
+        line_width (float): Line width of the elements.
+        min_points (int): Contours with fewer points are skipped, DSA
+            appears to reject polylines with only three points.
+
+    Returns:
+        (List[dict]) Element dictionaries.
+
+    """
+    lengths = np.array([len(contour) for contour in contours], dtype=int)
+    keep = np.flatnonzero(lengths >= min_points)
+
+    if not len(keep):
+        return []
+
+    points = np.concatenate([contours[i] for i in keep]).reshape(-1, 2)
+
+    xyz = np.zeros((len(points), 3), dtype=int)
+    xyz[:, :2] = points * np.asarray(scale, dtype=float)
+
+    # Python lists of ints, so the elements are JSON serializable.
+    xyz = xyz.tolist()
+    ends = np.cumsum(lengths[keep]).tolist()
+
+    return [
+        {
+            'group': label,
+            'type': 'polyline',
+            'lineColor': line_color,
+            'lineWidth': line_width,
+            'closed': True,
+            'points': xyz[end - length:end],
+            'label': {'value': label},
+        }
+        for end, length in zip(ends, lengths[keep].tolist())
+    ]
+
+
+def write_annotation(
+    fp: str, doc: dict,
+    elements: Optional[Union[List[dict], Iterable[List[dict]]]] = None,
+    use_orjson: bool = True
+):
+    """Write an annotation document to a JSON (.anot) file, streaming the
+    elements so the full element list is never held in memory or encoded at
+    once.
+
+    Args:
+        fp (str): Filepath to write to.
+        doc (dict): Annotation document. Its elements are written where the
+            "elements" key is, or last if it has no "elements" key.
+        elements (list | Iterable[list]): Elements to write instead of the
+            document's elements, either a list of elements or an iterable
+            of lists of elements (e.g. from box_elements).
+        use_orjson (bool): Encode the elements with orjson when it is
+            installed, which is much faster than the json module.
+
+    """
+    if elements is None:
+        elements = doc.get('elements', [])
+
+    if isinstance(elements, list) and \
+        (not len(elements) or isinstance(elements[0], dict)):
+        elements = [elements]
+
+    keys = list(doc.keys())
+
+    if 'elements' not in keys:
+        keys.append('elements')
+
+    with open(fp, 'wb') as fh:
+        fh.write(b'{')
+
+        for i, key in enumerate(keys):
+            if i:
+                fh.write(b',')
+
+            fh.write(_dumps(key, use_orjson=False) + b':')
+
+            if key != 'elements':
+                fh.write(_dumps(doc[key], use_orjson=False))
+                continue
+
+            fh.write(b'[')
+            first = True
+
+            for chunk in elements:
+                if not len(chunk):
+                    continue
+
+                if not first:
+                    fh.write(b',')
+
+                # Strip the brackets of the encoded chunk list.
+                fh.write(_dumps(chunk, use_orjson=use_orjson)[1:-1])
+                first = False
+
+            fh.write(b']')
+
+        fh.write(b'}')
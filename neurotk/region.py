@@ -0,0 +1,190 @@
+"""Parse slicer CLI region parameters and rasterize them into masks."""
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+import cv2 as cv
+import shapely
+from shapely.geometry.base import BaseGeometry
+
+
+def is_whole_region(region: Sequence[float]) -> bool:
+    """Check if a region is the [-1, -1, -1, -1] region, which signals the
+    whole image.
+
+    Args:
+        region (Sequence[float]): Region parameter.
+
+    Returns:
+        (bool) True if the region is the whole image.
+
+    """
+    region = np.asarray(region, dtype=float)
+
+    return len(region) == 4 and bool(np.all(region == -1))
+
+
+def region_polygons(region: Sequence[float]) -> Optional[List[np.ndarray]]:
+    """Parse a region parameter into polygons. A region of 4 values is a
+    rectangle given by left, top, width and height, otherwise it is a flat
+    list of x, y coordinates of one or more polygons separated by negative
+    values (usually -1, -1).
+
+    Args:
+        region (Sequence[float]): Region parameter.
+
+    Returns:
+        (List[numpy.ndarray] | None) [M, 2] x, y vertices of each polygon, or
+        None if the region is the whole image.
+
+    """
+    if is_whole_region(region):
+        return None
+
+    region = np.asarray(region, dtype=float)
+
+    if len(region) == 4:
+        left, top, width, height = region
+
+        return [np.array([
+            [left, top], [left + width, top], [left + width, top + height],
+            [left, top + height]
+        ])]
+
+    # Negative values separate polygons, label the coordinates of each.
+    sep = region < 0
+    polygon_ids = np.cumsum(sep)[~sep]
+    coords = region[~sep]
+
+    splits = np.flatnonzero(np.diff(polygon_ids)) + 1
+
+    return [
+        polygon.reshape(-1, 2) for polygon in np.split(coords, splits)
+        if len(polygon)
+    ]
+
+
+def region_mask(
+    region: Sequence[float], scale: float, shape: Tuple[int, int]
+) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """Rasterize a region parameter into a binary mask cropped to the
+    region's bounding box, so small regions on large images give small
+    masks.
+
+    Args:
+        region (Sequence[float]): Region parameter, see region_polygons.
+        scale (float): Multiplicative factor from region (full resolution)
+            coordinates to mask coordinates.
+        shape (Tuple[int, int]): Height and width of a mask of the whole
+            image, the cropped mask is clipped to it.
+
+    Returns:
+        (numpy.ndarray) The uint8 mask, 255 inside the region, and the x, y
+        offset of its top left corner in the mask of the whole image.
+
+    """
+    full_h, full_w = shape
+
+    if is_whole_region(region):
+        return np.full((full_h, full_w), 255, dtype=np.uint8), (0, 0)
+
+    region = np.asarray(region, dtype=float)
+
+    if len(region) == 4:
+        # Rectangles cover width x height pixels.
+        left, top, width, height = (region * scale).astype(int)
+
+        x1, y1 = max(left, 0), max(top, 0)
+        x2, y2 = min(left + width, full_w), min(top + height, full_h)
+
+        mask = np.full(
+            (max(y2 - y1, 0), max(x2 - x1, 0)), 255, dtype=np.uint8
+        )
+
+        return mask, (x1, y1)
+
+    contours = [
+        (polygon * scale).astype(int) for polygon in region_polygons(region)
+    ]
+
+    if not len(contours):
+        return np.zeros((0, 0), dtype=np.uint8), (0, 0)
+
+    points = np.concatenate(contours)
+
+    # Filled contours include their boundary pixels.
+    x1, y1 = np.maximum(points.min(axis=0), 0)
+    x2, y2 = np.minimum(points.max(axis=0) + 1, [full_w, full_h])
+
+    mask = np.zeros((max(y2 - y1, 0), max(x2 - x1, 0)), dtype=np.uint8)
+
+    if mask.size:
+        contours = [
+            (contour - [x1, y1]).astype(np.int32) for contour in contours
+        ]
+
+        mask = cv.drawContours(mask, contours, -1, 255, cv.FILLED)
+
+    return mask, (int(x1), int(y1))
+
+
+def polygons_geometry(polygons: Sequence[np.ndarray]) -> BaseGeometry:
+    """Union of polygons as a single valid shapely geometry.
+
+    Args:
+        polygons (Sequence[numpy.ndarray]): [M, 2] x, y vertices of each
+            polygon, e.g. from region_polygons. Polygons with less than 3
+            vertices are ignored.
+
+    Returns:
+        (shapely.geometry.base.BaseGeometry) Polygon or multipolygon, empty if
+        there are no valid polygons.
+
+    """
+    polygons = [
+        shapely.make_valid(shapely.Polygon(polygon)) for polygon in polygons
+        if len(polygon) >= 3
+    ]
+
+    if not len(polygons):
+        return shapely.Polygon()
+
+    geometry = shapely.union_all(polygons)
+
+    # Keep only the areas, e.g. degenerate polygons become lines.
+    parts = [
+        part for part in shapely.get_parts(geometry)
+        if isinstance(part, (shapely.Polygon, shapely.MultiPolygon))
+    ]
+
+    return shapely.union_all(parts) if parts else shapely.Polygon()
+
+
+def geometry_rings(
+    geometry: BaseGeometry
+) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    """Get the exterior and interior (hole) rings of the polygons of a
+    geometry. Fill all the rings in a single cv.fillPoly call, its even-odd
+    rule clears the holes while keeping polygons that lie inside another
+    polygon's hole. Filling the exteriors and then clearing the interiors
+    would erase those polygons.
+
+    Args:
+        geometry (shapely.geometry.base.BaseGeometry): Polygon or
+            multipolygon.
+
+    Returns:
+        (List[numpy.ndarray]) [M, 2] x, y coordinates of the exterior rings
+        and of the interior rings.
+
+    """
+    exteriors, interiors = [], []
+
+    for polygon in shapely.get_parts(geometry):
+        if polygon.is_empty:
+            continue
+
+        exteriors.append(np.asarray(polygon.exterior.coords))
+        interiors.extend(
+            np.asarray(interior.coords) for interior in polygon.interiors
+        )
+
+    return exteriors, interiors
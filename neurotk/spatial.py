@@ -0,0 +1,297 @@
+"""Spatial statistics of point detections."""
+from typing import List, Optional, Tuple
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+
+
+def _window_bins(
+    origins: np.ndarray, size: int, coords: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Bin coordinates along one axis so every window (origin, origin + size)
+    is a contiguous range of bins. Coordinates are doubled so that points
+    strictly inside a window, including centers on half pixels, fall in
+    half-open bins [2 * origin + 1, 2 * (origin + size)).
+
+    Returns:
+        (numpy.ndarray) Bin of each coordinate (-1 if before all windows),
+        the first and end bin of each window, and the number of bins.
+
+    """
+    lefts = 2 * origins + 1
+    rights = 2 * (origins + size)
+    edges = np.unique(np.concatenate([lefts, rights]))
+
+    bins = np.searchsorted(edges, 2 * coords, side='right') - 1
+
+    window_bins = np.column_stack([
+        np.searchsorted(edges, lefts), np.searchsorted(edges, rights)
+    ])
+
+    return bins, window_bins, len(edges)
+
+
+def window_counts(
+    points: np.ndarray, width: int, height: int, stride_x: int,
+    stride_y: int, extent: Tuple[int, int]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Count the points strictly inside each window of a grid of windows.
+    Points are binned into a 2D histogram with bins at the window stride
+    (plus thin bins for points on window edges) and the windows are scored
+    with a summed-area table, in constant time per window.
+
+    Args:
+        points (numpy.ndarray): [N, 2] x, y coordinates of the points.
+        width (int): Width of the windows.
+        height (int): Height of the windows.
+        stride_x (int): Horizontal distance between window origins.
+        stride_y (int): Vertical distance between window origins.
+        extent (Tuple[int, int]): Width and height of the image, windows
+            start at (0, 0) and their origins are inside the image.
+
+    Returns:
+        (numpy.ndarray) x and y origins of the windows and the
+        [len(x origins), len(y origins)] counts of points in each window.
+
+    """
+    xs = np.arange(0, extent[0], stride_x)
+    ys = np.arange(0, extent[1], stride_y)
+
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+
+    bx, wx, nx = _window_bins(xs, width, points[:, 0])
+    by, wy, ny = _window_bins(ys, height, points[:, 1])
+
+    valid = (bx >= 0) & (by >= 0)
+
+    hist = np.bincount(
+        bx[valid] * ny + by[valid], minlength=nx * ny
+    ).reshape(nx, ny)
+
+    # Summed-area table, padded with a leading row and column of zeros.
+    sat = np.zeros((nx + 1, ny + 1), dtype=int)
+    sat[1:, 1:] = hist.cumsum(0).cumsum(1)
+
+    x1, x2 = wx[:, 0, None], wx[:, 1, None]
+    y1, y2 = wy[None, :, 0], wy[None, :, 1]
+
+    counts = sat[x2, y2] - sat[x1, y2] - sat[x2, y1] + sat[x1, y1]
+
+    return xs, ys, counts
+
+
+def densest_window(
+    points: np.ndarray, width: int, height: int, stride_x: int,
+    stride_y: int, extent: Tuple[int, int]
+) -> Tuple[Optional[Tuple[int, int]], np.ndarray]:
+    """Find the window with the most points strictly inside it, from a grid
+    of windows starting at (0, 0). When windows tie, the first one with x
+    origins in the outer order and y origins in the inner order is returned.
+
+    Args:
+        points (numpy.ndarray): [N, 2] x, y coordinates of the points.
+        width (int): Width of the windows.
+        height (int): Height of the windows.
+        stride_x (int): Horizontal distance between window origins.
+        stride_y (int): Vertical distance between window origins.
+        extent (Tuple[int, int]): Width and height of the image.
+
+    Returns:
+        (Tuple[int, int] | None) x, y origin of the densest window, None if
+        no window has any points, and the indices of the points inside it.
+
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+
+    xs, ys, counts = window_counts(
+        points, width, height, stride_x, stride_y, extent
+    )
+
+    if not counts.size or counts.max() == 0:
+        return None, np.empty(0, dtype=int)
+
+    ix, iy = np.unravel_index(np.argmax(counts), counts.shape)
+    x, y = int(xs[ix]), int(ys[iy])
+
+    members = np.flatnonzero(
+        (points[:, 0] > x) & (points[:, 0] < x + width) &
+        (points[:, 1] > y) & (points[:, 1] < y + height)
+    )
+
+    return (x, y), members
+
+
+def radius_neighbours(
+    points: np.ndarray, radius: float, tree: Optional[cKDTree] = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Find all pairs of points within a radius of each other with a single
+    KD-tree query. Pairs for smaller radii are a filter of the result on the
+    distances.
+
+    Args:
+        points (numpy.ndarray): [N, 2] x, y coordinates of the points.
+        radius (float): Maximum distance between the points of a pair.
+        tree (scipy.spatial.cKDTree): Optional KD-tree already built on the
+            points.
+
+    Returns:
+        (numpy.ndarray) Indices i and j of each pair, with i < j, and their
+        distance.
+
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+
+    if tree is None:
+        tree = cKDTree(points)
+
+    pairs = tree.query_pairs(radius, output_type='ndarray')
+    i, j = pairs[:, 0], pairs[:, 1]
+
+    dist = np.hypot(*(points[i] - points[j]).T)
+
+    return i, j, dist
+
+
+def average_clustering(
+    n: int, i: np.ndarray, j: np.ndarray, block_size: int = 10000
+) -> float:
+    """Average clustering coefficient of an undirected graph given as edges,
+    with the same definition as networkx.average_clustering: the fraction of
+    pairs of neighbours of a node that are neighbours themselves, averaged
+    over all nodes and 0 for nodes with fewer than two neighbours.
+
+    Args:
+        n (int): Number of nodes.
+        i (numpy.ndarray): First node of each edge.
+        j (numpy.ndarray): Second node of each edge, each edge is given once.
+        block_size (int): Number of nodes whose triangles are counted at a
+            time, bounds the memory used by the sparse matrix products.
+
+    Returns:
+        (float) Average clustering coefficient, 0 for an empty graph.
+
+    """
+    if not n:
+        return 0.0
+
+    rows = np.concatenate([i, j])
+    cols = np.concatenate([j, i])
+
+    adj = csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(n, n)
+    )
+
+    degree = np.asarray(adj.sum(axis=1)).ravel()
+
+    # Each triangle through a node is found twice, once in each direction.
+    triangles = np.zeros(n)
+
+    for start in range(0, n, block_size):
+        block = adj[start:start+block_size]
+
+        triangles[start:start+block_size] = np.asarray(
+            block.multiply(block @ adj).sum(axis=1)
+        ).ravel()
+
+    pairs = degree * (degree - 1)
+    coef = np.divide(
+        triangles, pairs, out=np.zeros(n), where=pairs > 0
+    )
+
+    return float(coef.mean())
+
+
+def clustering_coefficients(
+    points: np.ndarray, radii: List[float]
+) -> List[float]:
+    """Average clustering coefficient of the graphs connecting points within
+    each radius of each other. The neighbours are found once for the largest
+    radius.
+
+    Args:
+        points (numpy.ndarray): [N, 2] x, y coordinates of the points.
+        radii (List[float]): Radii, in the units of the points.
+
+    Returns:
+        (List[float]) Average clustering coefficient for each radius.
+
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+
+    if not len(points) or not len(radii):
+        return [0.0] * len(radii)
+
+    i, j, dist = radius_neighbours(points, max(radii))
+
+    return [
+        average_clustering(len(points), i[dist <= r], j[dist <= r])
+        for r in radii
+    ]
+
+
+def spatial_statistics(
+    points: np.ndarray, radii: List[float], area: float, 
+    block_size: int = 10000
+) -> dict:
+    """Slide-wide spatial statistics of a set of points: average clustering
+    coefficients, Ripley's K and L functions, and nearest neighbour 
+    distances.
+
+    The points are sorted into spatial tiles as large as the largest radius
+    and a single KD-tree is queried for all the radii, so the neighbours of
+    the points counted together are close in memory.
+
+    Args:
+        points (numpy.ndarray): [N, 2] x, y coordinates of the points.
+        radii (List[float]): Radii, in the units of the points.
+        area (float): Area of the region the points were detected in, in the
+            units of the points squared. Used to estimate the intensity of 
+            the points in Ripley's K.
+        block_size (int): Number of points whose triangles are counted at a
+            time when calculating clustering coefficients.
+
+    Returns:
+        (dict) 'clustering', 'ripley_k' and 'ripley_l' lists with a value for
+        each radius, and a 'nn_distances' array with the distance of each 
+        point to its nearest neighbour. Ripley's K is estimated without edge 
+        correction, K(r) = area * pairs within r / (N * (N - 1)), and L(r) = 
+        sqrt(K(r) / pi).
+
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    n = len(points)
+
+    if n < 2 or not len(radii):
+        return {
+            'clustering': [0.0] * len(radii),
+            'ripley_k': [0.0] * len(radii),
+            'ripley_l': [0.0] * len(radii),
+            'nn_distances': np.empty(0)
+        }
+
+    # Sort the points by tile so the blocks of the adjacency are local.
+    tiles = np.floor((points - points.min(axis=0)) / max(max(radii), 1))
+    points = points[np.lexsort((tiles[:, 1], tiles[:, 0]))]
+
+    tree = cKDTree(points)
+
+    i, j, dist = radius_neighbours(points, max(radii), tree=tree)
+
+    clustering, ripley_k = [], []
+
+    for r in radii:
+        within = dist <= r
+
+        clustering.append(average_clustering(
+            n, i[within], j[within], block_size=block_size
+        ))
+        ripley_k.append(float(area * 2 * within.sum() / (n * (n - 1))))
+
+    nn_distances = tree.query(points, k=2)[0][:, 1]
+
+    return {
+        'clustering': clustering,
+        'ripley_k': ripley_k,
+        'ripley_l': [float(np.sqrt(k / np.pi)) for k in ripley_k],
+        'nn_distances': nn_distances
+    }
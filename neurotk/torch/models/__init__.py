@@ -1,2 +1,4 @@
 from .deeplabv3_model import deeplabv3_model
 from .UNet import UNet
+from .tissue_unet import TissueUNet
+from .export import export_model, export_parity
@@ -0,0 +1,94 @@
+"""Export segmentation models to TorchScript or ONNX, to run them with
+neurotk.torch.runtime.load_exported_model.
+
+"""
+import torch
+import torch.nn as nn
+
+
+class _TensorOutput(nn.Module):
+    """Wrap a model whose output may be a dictionary, such as torchvision's 
+    DeepLabV3, so it only outputs the 'out' tensor.
+    
+    """
+    def __init__(self, model: nn.Module):
+        super(_TensorOutput, self).__init__()
+        self.model = model
+        
+    def forward(self, x):
+        out = self.model(x)
+        
+        if isinstance(out, dict):
+            out = out['out']
+            
+        return out
+    
+    
+def export_model(
+    model: nn.Module, fp: str, size: int = 256, channels: int = 3, 
+    opset: int = 17
+) -> str:
+    """Export a segmentation model for CPU inference. The model is traced on
+    an input of the given size, so the export should be used with images
+    resized to it, as predict_masks does. The batch size is dynamic.
+    
+    Args:
+        model: Segmentation model, moved to CPU and eval mode in place.
+        fp: Filepath to save to, ONNX if it has a .onnx extension or a
+            frozen TorchScript module otherwise.
+        size: Size of the input images.
+        channels: Number of channels of the input images.
+        opset: ONNX opset version.
+        
+    Returns:
+        Filepath of the exported model.
+    
+    """
+    model = _TensorOutput(model.cpu().eval())
+    x = torch.rand(1, channels, size, size)
+    
+    with torch.no_grad():
+        if fp.endswith('.onnx'):
+            torch.onnx.export(
+                model, x, fp, input_names=['image'], output_names=['mask'],
+                dynamic_axes={'image': {0: 'batch'}, 'mask': {0: 'batch'}},
+                opset_version=opset
+            )
+        else:
+            torch.jit.freeze(torch.jit.trace(model, x)).save(fp)
+        
+    return fp
+
+
+def export_parity(
+    model: nn.Module, fp: str, size: int = 256, channels: int = 3, 
+    batch_size: int = 2, seed: int = 0
+) -> float:
+    """Compare the outputs of a model and its export on the same random 
+    batch, to check the export. The batch has more than one image to also
+    check the dynamic batch size.
+    
+    Args:
+        model: Segmentation model, moved to CPU and eval mode in place.
+        fp: Filepath of the exported model.
+        size: Size of the input images.
+        channels: Number of channels of the input images.
+        batch_size: Number of images in the batch.
+        seed: Random seed of the batch.
+        
+    Returns:
+        Maximum absolute difference between the outputs.
+    
+    """
+    from ..runtime import load_exported_model
+    
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.rand(batch_size, channels, size, size, generator=generator)
+    
+    model = _TensorOutput(model.cpu().eval())
+    exported = load_exported_model(fp)
+    
+    with torch.inference_mode():
+        diff = (model(x) - exported(x)).abs().max()
+    
+    return float(diff)
@@ -0,0 +1,44 @@
+import torch.nn as nn
+
+
+class TissueUNet(nn.Module):
+    """Small UNet used to segment tissue on whole slide image thumbnails, 
+    with a single downsampling encoder block and bottleneck.
+    
+    Args:
+        in_channels: Number of input channels, 3 for RGB images.
+        out_channels: Number of output channels or classes.
+        
+    """
+    def __init__(self, in_channels, out_channels):
+        super(TissueUNet, self).__init__()
+
+        self.encoder = nn.Sequential(
+            nn.Conv2d(in_channels, 64, kernel_size=3, padding=1),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(64, 64, kernel_size=3, padding=1),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(kernel_size=2, stride=2)
+        )
+
+        self.bottleneck = nn.Sequential(
+            nn.Conv2d(64, 128, kernel_size=3, padding=1),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(128, 128, kernel_size=3, padding=1),
+            nn.ReLU(inplace=True),
+            nn.MaxPool2d(kernel_size=2, stride=2)
+        )
+
+        self.decoder = nn.Sequential(
+            nn.Conv2d(128, 64, kernel_size=3, padding=1),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(64, 64, kernel_size=3, padding=1),
+            nn.ReLU(inplace=True),
+            nn.ConvTranspose2d(64, out_channels, kernel_size=2, stride=2)
+        )
+
+    def forward(self, x):
+        enc1 = self.encoder(x)
+        bottle = self.bottleneck(enc1)
+        dec1 = self.decoder(bottle)
+        return dec1
@@ -0,0 +1,204 @@
+"""Run segmentation models exported to TorchScript or ONNX on CPU, and pick
+between a PyTorch model and its exports. This module does not import 
+torchvision, so loading an exported model skips importing its model zoo.
+
+"""
+from typing import Callable, Optional
+import traceback
+import numpy as np
+import torch
+import torch.nn as nn
+
+from os import remove
+from os.path import isfile, splitext
+
+
+# Maximum absolute difference of the outputs of an export and the PyTorch
+# model for the export to be used.
+PARITY_TOL = 1e-3
+
+
+class OnnxModel(nn.Module):
+    """ONNX model run with ONNX Runtime on CPU. It is called like a torch
+    model on a batch of image tensors, so it can be passed to predict_masks.
+    
+    Args:
+        fp: Filepath to the ONNX model.
+        num_threads: Number of threads ONNX Runtime uses, defaults to its own
+            default.
+            
+    Attributes:
+        session (onnxruntime.InferenceSession): Inference session.
+        input_name (str): Name of the model's input.
+    
+    """
+    def __init__(self, fp: str, num_threads: Optional[int] = None):
+        super(OnnxModel, self).__init__()
+        
+        import onnxruntime as ort
+        
+        options = ort.SessionOptions()
+        options.graph_optimization_level = \
+            ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+            
+        self.session = ort.InferenceSession(
+            fp, options, providers=['CPUExecutionProvider']
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        
+    def forward(self, x):
+        x = np.ascontiguousarray(x.detach().cpu().numpy(), dtype=np.float32)
+        
+        return torch.from_numpy(
+            self.session.run(None, {self.input_name: x})[0]
+        )
+    
+    
+def load_exported_model(
+    fp: str, num_threads: Optional[int] = None
+) -> nn.Module:
+    """Load a model exported with neurotk.torch.models.export_model on CPU.
+    
+    Args:
+        fp: Filepath to the exported model, ONNX if it has a .onnx extension
+            or TorchScript otherwise.
+        num_threads: Number of threads ONNX Runtime uses, TorchScript models
+            use torch's setting.
+            
+    Returns:
+        Model in eval mode, outputting a tensor.
+    
+    """
+    if fp.endswith('.onnx'):
+        return OnnxModel(fp, num_threads=num_threads).eval()
+    
+    model = torch.jit.load(fp, map_location='cpu').eval()
+    
+    # Fuse and convert operations of the frozen module for CPU inference.
+    return torch.jit.optimize_for_inference(model)
+
+
+def load_weights(model_fn: Callable, weights: str) -> nn.Module:
+    """Build a PyTorch model and load its weights on CPU.
+    
+    Args:
+        model_fn: Called without arguments to build the model's 
+            architecture.
+        weights: Filepath to the model's state dict.
+        
+    Returns:
+        Model in eval mode.
+    
+    """
+    model = model_fn()
+    model.load_state_dict(torch.load(weights, map_location='cpu'))
+    
+    return model.eval()
+
+
+def export_path(weights: str, runtime: str, size: int) -> str:
+    """Filepath of the export of a model for a runtime and input size, next
+    to its weights.
+    
+    Args:
+        weights: Filepath to the model's weights.
+        runtime: 'torchscript' or 'onnx'.
+        size: Size of the input images.
+        
+    Returns:
+        Filepath of the export.
+    
+    """
+    ext = '.onnx' if runtime == 'onnx' else '.torchscript.pt'
+    
+    return f'{splitext(weights)[0]}-{size}{ext}'
+
+
+def export_runtime(
+    model: nn.Module, weights: str, runtime: str, size: int, 
+    tol: float = PARITY_TOL
+) -> str:
+    """Export a model for a runtime and input size next to its weights (see
+    export_path), and check the export against the model.
+    
+    Args:
+        model: PyTorch model.
+        weights: Filepath to the model's weights.
+        runtime: 'torchscript' or 'onnx'.
+        size: Size of the input images.
+        tol: Maximum absolute difference of the outputs of the export and 
+            the model.
+            
+    Returns:
+        Filepath of the export.
+        
+    Raises:
+        RuntimeError if the outputs differ by more than tol, the export is 
+            deleted.
+    
+    """
+    # Imported here, loading an exported model skips torchvision's models.
+    from .models import export_model, export_parity
+    
+    fp = export_path(weights, runtime, size)
+    
+    print(f'Exporting model to {fp}')
+    export_model(model, fp, size=size)
+    
+    diff = export_parity(model, fp, size=size)
+    print(f'Max absolute difference of exported model outputs: {diff}')
+    
+    # Also fails on NaN differences.
+    if not diff <= tol:
+        remove(fp)
+        raise RuntimeError(
+            f'Export {fp} differs from the PyTorch model by {diff}, more '
+            f'than the tolerance of {tol}.'
+        )
+    
+    return fp
+
+
+def load_runtime_model(
+    runtime: str, weights: str, model_fn: Callable, size: int, 
+    tol: float = PARITY_TOL
+) -> nn.Module:
+    """Load a segmentation model for a runtime: the PyTorch model, or its 
+    TorchScript or ONNX export for an input size. Exports are looked for 
+    next to the weights (see export_path). Missing exports are created and 
+    checked on first use, if that fails the PyTorch model is used instead.
+    
+    Args:
+        runtime: 'torch', 'torchscript' or 'onnx'.
+        weights: Filepath to the model's weights.
+        model_fn: Called without arguments to build the model's 
+            architecture, only when the PyTorch model is needed.
+        size: Size of the input images.
+        tol: Maximum absolute difference of the outputs of a new export and
+            the PyTorch model.
+            
+    Returns:
+        Model in eval mode, outputting a tensor or a dictionary with the 
+        tensor under 'out'.
+    
+    """
+    if runtime == 'torch':
+        return load_weights(model_fn, weights)
+    
+    fp = export_path(weights, runtime, size)
+    
+    if not isfile(fp):
+        model = load_weights(model_fn, weights)
+        
+        try:
+            export_runtime(model, weights, runtime, size, tol=tol)
+        except Exception:
+            traceback.print_exc()
+            print('Export failed, running the PyTorch model instead.')
+            
+            return model
+        
+    return load_exported_model(fp)
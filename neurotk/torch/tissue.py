@@ -0,0 +1,411 @@
+"""Multi-resolution tissue segmentation of whole slide images."""
+from typing import Callable, List, Sequence, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import traceback
+import numpy as np
+import cv2 as cv
+import large_image
+import torch.nn as nn
+
+from .utils import predict_masks
+from ..annotations import contour_elements
+
+
+def boundary_cells(
+    mask: np.ndarray, factor: int, cell_size: int, margin: int = 1
+) -> np.ndarray:
+    """Find the cells of a grid over a mask upsampled by a factor that
+    contain the boundary of the mask. Cells are scored with a summed-area
+    table of the boundary pixels on the mask, without upsampling it.
+
+    Args:
+        mask: Binary mask.
+        factor: Upsampling factor of the mask the grid is on.
+        cell_size: Size of the cells of the grid, in upsampled pixels.
+        margin: Mask pixels within this distance of the boundary are also
+            considered boundary.
+
+    Returns:
+        [N, 2] row and column of the cells containing the boundary.
+
+    """
+    mask = (mask > 0).astype(np.uint8)
+    h, w = mask.shape
+
+    # Pixels whose neighbourhood has both tissue and background.
+    kernel = np.ones((2 * margin + 1, 2 * margin + 1), dtype=np.uint8)
+    band = cv.dilate(mask, kernel) != cv.erode(mask, kernel)
+
+    sat = np.zeros((h + 1, w + 1), dtype=int)
+    sat[1:, 1:] = band.cumsum(0).cumsum(1)
+
+    rows = np.arange(-(-h * factor // cell_size))
+    cols = np.arange(-(-w * factor // cell_size))
+
+    # Mask pixels overlapped by each cell, rounded outwards.
+    y1 = np.minimum(rows * cell_size // factor, h)[:, None]
+    y2 = np.minimum(-(-(rows + 1) * cell_size // factor), h)[:, None]
+    x1 = np.minimum(cols * cell_size // factor, w)[None, :]
+    x2 = np.minimum(-(-(cols + 1) * cell_size // factor), w)[None, :]
+
+    counts = sat[y2, x2] - sat[y1, x2] - sat[y2, x1] + sat[y1, x1]
+
+    return np.argwhere(counts > 0)
+
+
+def refine_tissue_mask(
+    ts, model: nn.Module, mask: np.ndarray, factor: int,
+    tile_size: int = 256, overlap: int = 32, thresh: float = 0.7,
+    norm: dict = None, batch_size: int = 8, workers: int = 4
+) -> np.ndarray:
+    """Refine the boundaries of a tissue mask predicted on a slide's
+    thumbnail at a higher resolution. The mask is upsampled by a factor and
+    only the grid cells containing its boundary are segmented again, with a
+    sliding window over regions read from the slide at the upsampled
+    resolution. Each window is a cell plus an overlap of context on each
+    side, only the prediction of the cell is stitched into the mask.
+
+    Windows are read by a thread pool, the next batch while the current one
+    is predicted on.
+
+    Args:
+        ts: Large image tile source of the slide.
+        model: Segmentation model, outputting a single channel.
+        mask: Tissue mask predicted on the thumbnail, covering the whole slide
+            without padding.
+        factor: Resolution of the refined mask, as a multiple of the mask
+            resolution. Should not exceed the full resolution of the slide.
+        tile_size: Size of the windows, usually the model's input size.
+        overlap: Context on each side of the cells, in refined pixels. Cells
+            are tile_size - 2 * overlap wide.
+        thresh: Threshold on the model output for positive pixels.
+        norm: Dictionary with RGB 'mean' and 'std' to normalize with,
+            defaults to ImageNet values.
+        batch_size: Number of windows in each forward pass of the model.
+        workers: Number of threads reading windows.
+
+    Returns:
+        Refined uint8 mask, factor times the height and width of the mask.
+
+    """
+    cell_size = tile_size - 2 * overlap
+
+    if cell_size <= 0:
+        raise ValueError('overlap must be less than half of tile_size')
+
+    ts_metadata = ts.getMetadata()
+
+    h, w = mask.shape[:2]
+    rh, rw = h * factor, w * factor
+
+    # Full resolution pixels per refined pixel.
+    sx, sy = ts_metadata['sizeX'] / rw, ts_metadata['sizeY'] / rh
+
+    # Cells away from the boundary keep the upsampled coarse prediction.
+    mask = ((mask > 0) * 255).astype(np.uint8)
+    refined = cv.resize(mask, (rw, rh), None, None, cv.INTER_NEAREST)
+
+    cells = boundary_cells(mask, factor, cell_size)
+
+    print(f'Refining {len(cells)} boundary cells at {factor}x resolution.')
+
+    def read_window(cell):
+        r, c = cell
+
+        # Window in refined pixels, clipped to the slide.
+        x, y = c * cell_size - overlap, r * cell_size - overlap
+        x1, y1 = max(x, 0), max(y, 0)
+        x2, y2 = min(x + tile_size, rw), min(y + tile_size, rh)
+
+        img = ts.getRegion(
+            region={
+                'left': int(round(x1 * sx)), 'top': int(round(y1 * sy)),
+                'right': int(round(x2 * sx)), 'bottom': int(round(y2 * sy))
+            },
+            output={'maxWidth': x2 - x1, 'maxHeight': y2 - y1},
+            format=large_image.constants.TILE_FORMAT_NUMPY
+        )[0][:, :, :3]
+
+        img = cv.resize(img, (x2 - x1, y2 - y1), None, None, cv.INTER_LINEAR)
+
+        # Pad outside the slide with white, as the thumbnail.
+        window = np.full((tile_size, tile_size, 3), 255, dtype=np.uint8)
+        window[y1 - y:y2 - y, x1 - x:x2 - x] = img
+
+        return window
+
+    batches = [
+        cells[i:i+batch_size] for i in range(0, len(cells), batch_size)
+    ]
+
+    if not len(batches):
+        return refined
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        def submit(batch):
+            return [executor.submit(read_window, cell) for cell in batch]
+
+        futures = submit(batches[0])
+
+        for b, batch in enumerate(batches):
+            windows = np.stack([future.result() for future in futures])
+
+            # Read the next batch while this one is predicted on.
+            if b + 1 < len(batches):
+                futures = submit(batches[b + 1])
+
+            preds = predict_masks(
+                model, windows, size=tile_size, norm=norm, thresh=thresh,
+                batch_size=batch_size
+            )
+
+            # Stitch the center of each window into the mask.
+            for (r, c), pred in zip(batch, preds):
+                x, y = c * cell_size, r * cell_size
+                cw, ch = min(cell_size, rw - x), min(cell_size, rh - y)
+
+                refined[y:y + ch, x:x + cw] = \
+                    pred[overlap:overlap + ch, overlap:overlap + cw]
+
+    return refined
+
+
+def _reshape_with_pad(img, size, pad=(255, 255, 255)):
+    """Reshape an image into a square aspect ratio without changing the 
+    original image aspect ratio - i.e. use padding.
+    
+    """
+    h, w = img.shape[:2]
+
+    if w > h:
+        img = cv.copyMakeBorder(
+            img, 0, w-h, 0, 0, cv.BORDER_CONSTANT, None, pad
+        )
+    else:
+        img = cv.copyMakeBorder(
+            img, 0, 0, 0, h-w, cv.BORDER_CONSTANT, None, pad
+        )
+
+    # Reshape the image.
+    img = cv.resize(img, (size, size), None, None, cv.INTER_NEAREST)
+
+    return img
+
+
+def read_thumbnail(fp: str, size: int) -> Tuple[np.ndarray, Tuple, dict]:
+    """Read the thumbnail of a slide, with its longest side at the given 
+    size, and pad it into a square image with white.
+    
+    Args:
+        fp: Filepath to the slide.
+        size: Size of the square thumbnail.
+        
+    Returns:
+        Padded RGB thumbnail, height and width of the thumbnail before 
+        padding, and the metadata of the slide's tile source.
+    
+    """
+    # Tile source.
+    ts = large_image.getTileSource(fp)
+
+    # Get size of WSI.
+    ts_metadata = ts.getMetadata()
+    w, h = ts_metadata['sizeX'], ts_metadata['sizeY']
+    
+    print(f'Size of WSI: {w}, {h}')
+
+    # Get thumbnail of image at the desired size.
+    kwargs = dict(format=large_image.tilesource.TILE_FORMAT_NUMPY)
+    
+    if w > h:
+        img = ts.getThumbnail(width=size, **kwargs)[0][:, :, :3]
+    else:
+        img = ts.getThumbnail(height=size, **kwargs)[0][:, :, :3]
+        
+    print(f'Original size of thumbnail: {img.shape}')
+    lr_shape = img.shape[:2]
+    
+    # Pad the image.
+    img = _reshape_with_pad(img, size, pad=(255, 255, 255))
+    
+    print(f'Size of thumbnail after reshape: {img.shape}')
+    
+    return img, lr_shape, ts_metadata
+
+
+def tissue_elements(
+    mask: np.ndarray, lr_shape: Tuple[int, int], ts_metadata: dict, 
+    smooth: float = 0.1
+) -> Tuple[List[dict], dict]:
+    """Convert a tissue mask predicted on a slide's thumbnail into DSA 
+    polyline elements at full resolution, with statistics of the tissue.
+    
+    Args:
+        mask: Binary uint8 tissue mask, with the slide in its top left corner
+            and padding elsewhere (see read_thumbnail).
+        lr_shape: Height and width of the slide in the mask.
+        ts_metadata: Metadata of the slide's tile source.
+        smooth: Tolerance of the polygon approximation of the contours, in 
+            mask pixels.
+            
+    Returns:
+        Polyline elements, and the tissue area in mm^2 ('area_mm') and number
+        of points ('num_points') and polygons ('num_polygons').
+    
+    """
+    print(f'Size of prediction: {mask.shape}')
+    
+    lr_h, lr_w = lr_shape
+    sf_h, sf_w = ts_metadata['sizeY'] / lr_h, ts_metadata['sizeX'] / lr_w
+    
+    # Extract contours.    
+    contours, hierarchy  = cv.findContours(
+        mask, cv.RETR_TREE, cv.CHAIN_APPROX_SIMPLE
+    )
+    
+    # Get the area of the contour.
+    pos_area = 0
+    neg_area = 0
+    
+    for i, contour in enumerate(contours):
+        if hierarchy[0, i, 3] == -1:
+            pos_area += cv.contourArea(contour)
+        else:
+            neg_area += cv.contourArea(contour)
+            
+    area = pos_area - neg_area
+    
+    print(f'Area in pixels at the original thumbnail size: {area}')
+    
+    # Convert the area in pixels's square in thumbnail size to original size.
+    sf = sf_w * sf_h
+    print(f'Scale factor going from thumbnail area to full resolution area: {sf}')
+    area = area * sf
+    print(f'Area in full resolution pixels: {area}')
+    area = area * (ts_metadata['mm_x'] * ts_metadata['mm_y'])
+    print(f'Area in mm^2: {area}')
+    
+    # Smoothe the contours
+    smoothed_contours = [
+        cv.approxPolyDP(contour, smooth, True) for contour in contours
+    ]
+    
+    # Convert the contours into DSA polyline elements at full resolution.
+    elements = contour_elements(
+        smoothed_contours, 'tissue', 'rgb(0,179,60)', scale=(sf_w, sf_h),
+        line_width=4.0
+    )
+    
+    n_polygons = len(elements)
+    n_points = sum(len(el['points']) for el in elements)
+    
+    print(f'Number of polygons: {n_polygons}, number of points: {n_points}')
+    
+    stats = {
+        'area_mm': area, 'num_points': n_points, 'num_polygons': n_polygons
+    }
+    
+    return elements, stats
+
+
+def segment_slides(
+    fps: Sequence[str], model: nn.Module, analyze: Callable, size: int = 256,
+    thresh: float = 0.7, batch_size: int = 8, workers: int = 4, 
+    refine_factor: int = 1
+) -> List[int]:
+    """Segment the tissue of many slides with one model. Thumbnails are read
+    by a thread pool, the next batch while the current one is predicted on, 
+    and predicted on in batches. A slide that fails to be read, refined or 
+    analyzed is reported and skipped, the other slides are still processed.
+    
+    Args:
+        fps: Filepaths to the slides.
+        model: Segmentation model, outputting a single channel.
+        analyze: Called with the index of each slide, its mask, the height 
+            and width of the slide in the mask and its tile source metadata, 
+            e.g. to save the mask as an annotation.
+        size: Size of the thumbnails and of the windows when refining.
+        thresh: Threshold on the model output for positive pixels.
+        batch_size: Number of thumbnails in each forward pass of the model.
+        workers: Number of threads reading thumbnails and refinement windows.
+        refine_factor: If above 1, the tissue boundaries are segmented again
+            at this multiple of the thumbnail resolution (see 
+            refine_tissue_mask).
+            
+    Returns:
+        Indices of the slides that failed.
+    
+    """
+    batch_size = max(batch_size, 1)
+    batches = [
+        list(range(i, min(i + batch_size, len(fps))))
+        for i in range(0, len(fps), batch_size)
+    ]
+    
+    failed = []
+    
+    def log_failure(i):
+        print(f'Failed to process {fps[i]}:')
+        traceback.print_exc()
+        failed.append(i)
+        
+    if not len(batches):
+        return failed
+    
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        def submit(batch):
+            return [
+                executor.submit(read_thumbnail, fps[i], size) for i in batch
+            ]
+        
+        futures = submit(batches[0])
+        
+        for b, batch in enumerate(batches):
+            read = []
+            
+            for i, future in zip(batch, futures):
+                try:
+                    read.append((i, future.result()))
+                except Exception:
+                    log_failure(i)
+            
+            # Read the next batch while this one is predicted on.
+            if b + 1 < len(batches):
+                futures = submit(batches[b + 1])
+                
+            if not len(read):
+                continue
+            
+            # Padded thumbnails have the same shape and are stacked.
+            masks = predict_masks(
+                model, np.stack([img for _, (img, _, _) in read]), 
+                size=size, thresh=thresh, batch_size=batch_size
+            )
+            
+            for (i, (_, lr_shape, ts_metadata)), mask in zip(read, masks):
+                print(f'Slide {i + 1} of {len(fps)}: {fps[i]}')
+                
+                try:
+                    if refine_factor > 1:
+                        # Segment the boundary again at a higher resolution.
+                        lr_h, lr_w = lr_shape
+                        
+                        mask = refine_tissue_mask(
+                            large_image.getTileSource(fps[i]), model, 
+                            mask[:lr_h, :lr_w], refine_factor, 
+                            tile_size=size, thresh=thresh, 
+                            batch_size=batch_size, workers=workers
+                        )
+                        lr_shape = mask.shape[:2]
+                        
+                    analyze(i, mask, lr_shape, ts_metadata)
+                except Exception:
+                    log_failure(i)
+                    
+    if failed:
+        print(f'Failed to process {len(failed)} of {len(fps)} slides:')
+        
+        for i in sorted(failed):
+            print(f'  {fps[i]}')
+            
+    return sorted(failed)
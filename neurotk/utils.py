@@ -1,11 +1,14 @@
 """Utility functions."""
-from typing import List
+from typing import List, Optional, Sequence, Tuple
 from shapely.geometry.polygon import Polygon
 import numpy as np
-from geopandas import GeoSeries
+import heapq
+from hashlib import sha1
+from geopandas import points_from_xy
+from geopandas.array import GeometryArray
 
 from os import makedirs
-from os.path import basename, splitext
+from os.path import basename, splitext, isfile, join, abspath
 
 
 def create_dirs(dirs: List[str], exist_ok: bool = True):
@@ -65,9 +68,8 @@ def contours_to_points(contours: List) -> List:
     points = []
     
     for contour in contours:
-        points.append([
-            [float(pt[0][0]), float(pt[0][1]), 0] for pt in contour
-        ])
+        xy = np.reshape(contour, (-1, 2)).astype(float).tolist()
+        points.append([[x, y, 0] for x, y in xy])
         
     return points
 
@@ -91,6 +93,109 @@ def get_filename(fp: str, prune_ext: bool = True) -> str:
     return fn
 
 
+def read_manifest(
+    manifest: str, out_dir: str = '.', ext: str = 'anot', 
+    reserved: Sequence[str] = ()
+) -> List[Tuple[str, str]]:
+    """Read a manifest of images to process in a batch. The manifest is 
+    either a filepath to a text file with one image per line, or a comma 
+    separated list of images. Each line of the file can optionally give the
+    output filepath after a comma, e.g. "/data/slide.svs,/out/slide.anot". 
+    Empty lines and lines starting with # are ignored.
+    
+    Outputs not given in the manifest are named after the image. When that
+    name is already taken, e.g. by images with the same filename in
+    different directories, a short hash of the image filepath is added to
+    it, so no two images write to the same output.
+    
+    Args:
+        manifest: Filepath to the manifest file, or comma separated images.
+        out_dir: Directory of the outputs not given in the manifest.
+        ext: Extension of the outputs not given in the manifest, the 
+            filename is the image's filename with this extension.
+        reserved: Output filepaths already used by other images.
+            
+    Returns:
+        List of image and output filepaths.
+        
+    Raises:
+        ValueError: If the manifest gives the same output for two images.
+        
+    """
+    if isfile(manifest):
+        with open(manifest, 'r') as fh:
+            lines = [line.strip() for line in fh]
+    else:
+        lines = [fp.strip() for fp in manifest.split(',')]
+        
+    entries = []
+    
+    for line in lines:
+        if not line or line.startswith('#'):
+            continue
+        
+        if ',' in line:
+            fp, out_fp = [v.strip() for v in line.split(',', 1)]
+        else:
+            fp, out_fp = line, None
+            
+        entries.append((fp, out_fp))
+        
+    # Outputs given in the manifest are taken first.
+    taken = {abspath(out_fp) for out_fp in reserved}
+    
+    for _, out_fp in entries:
+        if out_fp is None:
+            continue
+        
+        if abspath(out_fp) in taken:
+            raise ValueError(f'Output {out_fp} is used by more than one image.')
+        
+        taken.add(abspath(out_fp))
+        
+    for i, (fp, out_fp) in enumerate(entries):
+        if out_fp is not None:
+            continue
+        
+        name = get_filename(fp)
+        out_fp = join(out_dir, f'{name}.{ext}')
+        
+        if abspath(out_fp) in taken:
+            # Disambiguate with the image filepath, and a counter for images
+            # listed more than once.
+            name += '-' + sha1(abspath(fp).encode()).hexdigest()[:8]
+            out_fp = join(out_dir, f'{name}.{ext}')
+            k = 1
+            
+            while abspath(out_fp) in taken:
+                k += 1
+                out_fp = join(out_dir, f'{name}-{k}.{ext}')
+                
+        taken.add(abspath(out_fp))
+        entries[i] = (fp, out_fp)
+        
+    return entries
+
+
+def slide_subdir(directory: str, fp: str) -> str:
+    """Subdirectory of a directory shared by a batch of images, e.g. a 
+    checkpoint directory, that is unique to an image. Named after the image
+    and a short hash of its filepath, so images with the same filename in
+    different directories do not share it.
+    
+    Args:
+        directory: Directory shared by the batch.
+        fp: Filepath to the image.
+        
+    Returns:
+        Filepath of the subdirectory.
+        
+    """
+    digest = sha1(abspath(fp).encode()).hexdigest()[:8]
+    
+    return join(directory, f'{get_filename(fp)}-{digest}')
+
+
 def im_to_txt_path(impath: str, txt_dir: str = '/labels/', ext='txt'):
     """Replace the last occurance of /images/ to /labels/ in the given image 
     path and change extension to .txt
@@ -122,7 +227,314 @@ def corners_to_polygon(x1: int, y1: int, x2: int, y2: int) -> Polygon:
     return Polygon([(x1, y1), (x2, y1), (x2, y2), (x1, y2)])
 
 
-def non_max_suppression(df, thr):
+def box_centroids(boxes: np.ndarray) -> np.ndarray:
+    """Get the centers of boxes.
+    
+    Args:
+        boxes: [N, 4] array of boxes in (x1, y1, x2, y2) format.
+        
+    Returns:
+        [N, 2] array of x, y centers.
+        
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    
+    return (boxes[:, :2] + boxes[:, 2:]) / 2
+
+
+def box_centroid_points(boxes: np.ndarray) -> GeometryArray:
+    """Get the centers of boxes as shapely points, created in a single 
+    vectorized call.
+    
+    Args:
+        boxes: [N, 4] array of boxes in (x1, y1, x2, y2) format.
+        
+    Returns:
+        Geometry array of points, can be assigned as the geometry of a 
+        GeoDataFrame.
+        
+    """
+    centroids = box_centroids(boxes)
+    
+    return points_from_xy(centroids[:, 0], centroids[:, 1])
+
+
+def box_overlap_pairs(
+    boxes: np.ndarray, margin: float = 0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Find all pairs of overlapping boxes. Boxes are binned into a uniform 
+    grid with cells the size of the median box, each box in every cell it 
+    covers, so only boxes sharing a cell are compared. The number of 
+    comparisons grows with the number of boxes per cell, not with the size 
+    of the largest box or of clusters of overlapping boxes.
+    
+    Args:
+        boxes: [N, 4] array of boxes in (x1, y1, x2, y2) format.
+        margin: Boxes with a gap of up to this many pixels between them are 
+            also considered overlapping.
+            
+    Returns:
+        Indices i and j of each overlapping pair, with i < j, sorted by i 
+        then j.
+        
+    """
+    n = len(boxes)
+    
+    if n < 2:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    
+    # Extending boxes by the margin, boxes overlap if their extents intersect.
+    x1, y1 = boxes[:, 0], boxes[:, 1]
+    x2, y2 = boxes[:, 2] + margin, boxes[:, 3] + margin
+    
+    cell = np.median(np.maximum(x2 - x1, y2 - y1))
+    cell = cell if cell > 0 else 1
+    
+    cx1 = np.floor(x1 / cell).astype(int)
+    cy1 = np.floor(y1 / cell).astype(int)
+    cx2 = np.maximum(np.floor(x2 / cell).astype(int), cx1)
+    cy2 = np.maximum(np.floor(y2 / cell).astype(int), cy1)
+    
+    ox, oy = cx1.min(), cy1.min()
+    n_rows = cy2.max() - oy + 1
+    
+    # One entry per box and cell it covers.
+    nx, ny = cx2 - cx1 + 1, cy2 - cy1 + 1
+    counts = nx * ny
+    box = np.repeat(np.arange(n), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    gx = cx1[box] + k // ny[box] - ox
+    gy = cy1[box] + k % ny[box] - oy
+    cells = gx * n_rows + gy
+    
+    order = np.argsort(cells, kind='stable')
+    box, cells = box[order], cells[order]
+    
+    # Pair each entry with the entries after it in the same cell.
+    end = np.searchsorted(cells, cells, side='right')
+    counts = end - np.arange(len(cells)) - 1
+    
+    p = np.repeat(np.arange(len(cells)), counts)
+    q = p + 1 + np.arange(counts.sum()) - np.repeat(
+        np.cumsum(counts) - counts, counts
+    )
+    i, j = box[p], box[q]
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    
+    overlap = (x1[i] <= x2[j]) & (x1[j] <= x2[i]) & \
+        (y1[i] <= y2[j]) & (y1[j] <= y2[i])
+    i, j, cells = i[overlap], j[overlap], cells[p[overlap]]
+    
+    # Report each pair once, in the cell of its intersection's top left.
+    ref = (np.floor(np.maximum(x1[i], x1[j]) / cell).astype(int) - ox) * \
+        n_rows + np.floor(np.maximum(y1[i], y1[j]) / cell).astype(int) - oy
+    i, j = i[cells == ref], j[cells == ref]
+    
+    order = np.lexsort((j, i))
+    
+    return i[order], j[order]
+
+
+def box_ious(
+    boxes: np.ndarray, labels: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Find the IoU of every pair of overlapping boxes, using the inclusive 
+    pixel convention where a box covers (x2 - x1 + 1) * (y2 - y1 + 1) pixels.
+    
+    Args:
+        boxes: [N, 4] array of boxes in (x1, y1, x2, y2) format.
+        labels: Optional [N] array of labels, only pairs of boxes with the 
+            same label are returned.
+            
+    Returns:
+        Indices i and j of each overlapping pair, with i < j, and their IoU.
+        
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    
+    # Boxes one pixel apart share a pixel row or column.
+    i, j = box_overlap_pairs(boxes, margin=1)
+    
+    if labels is not None:
+        labels = np.asarray(labels)
+        same = labels[i] == labels[j]
+        i, j = i[same], j[same]
+    
+    areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+    
+    w = np.maximum(0.0, np.minimum(boxes[i, 2], boxes[j, 2]) - \
+        np.maximum(boxes[i, 0], boxes[j, 0]) + 1)
+    h = np.maximum(0.0, np.minimum(boxes[i, 3], boxes[j, 3]) - \
+        np.maximum(boxes[i, 1], boxes[j, 1]) + 1)
+    inter = w * h
+    
+    ious = inter / (areas[i] + areas[j] - inter)
+    overlap = ious > 0
+    
+    return i[overlap], j[overlap], ious[overlap]
+
+
+def _neighbour_lists(
+    n: int, i: np.ndarray, j: np.ndarray, values: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Symmetric adjacency in CSR form (indptr, indices, values) from the
+    pairs i < j.
+    
+    """
+    src = np.concatenate([i, j])
+    dst = np.concatenate([j, i])
+    values = np.concatenate([values, values])
+    
+    order = np.argsort(src, kind='stable')
+    indptr = np.zeros(n + 1, dtype=int)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+    
+    return indptr, dst[order], values[order]
+
+
+def batched_nms(
+    boxes: np.ndarray, scores: np.ndarray, labels: Optional[np.ndarray] = None,
+    thr: float = 0.5, method: str = 'greedy', sigma: float = 0.5, 
+    score_thr: float = 0.0
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Non-max suppression of boxes, per label when labels are given. 
+    
+    The IoU of every pair of overlapping boxes is computed once with a 
+    spatial grid join (see box_overlap_pairs), so each box is only compared
+    with its neighbours instead of all remaining boxes.
+    
+    Methods:
+        greedy: Keep the highest scoring box and remove the boxes with an 
+            IoU above thr with it, repeat on the remaining boxes.
+        soft: Soft-NMS, instead of being removed the scores of overlapping
+            boxes are decayed with a Gaussian of their IoU, exp(-IoU^2 / 
+            sigma). Boxes whose score falls below score_thr are removed.
+        soft-linear: Soft-NMS with a linear decay, scores of boxes with an
+            IoU above thr are multiplied by 1 - IoU.
+        wbf: Weighted box fusion, boxes are clustered around the boxes kept
+            by greedy NMS and each cluster is replaced by the score weighted
+            average of its boxes, with the mean score of the cluster.
+            
+    Args:
+        boxes: [N, 4] array of boxes in (x1, y1, x2, y2) format.
+        scores: [N] array of box scores.
+        labels: Optional [N] array of labels, boxes only suppress boxes with
+            the same label. If None suppression is class agnostic.
+        thr: IoU threshold.
+        method: One of 'greedy', 'soft', 'soft-linear', or 'wbf'.
+        sigma: Gaussian decay parameter of the soft method.
+        score_thr: Minimum score for a box to be kept by the soft methods.
+        
+    Returns:
+        Indices of the boxes kept from highest to lowest score, and their 
+        [M, 4] boxes and [M] scores. Only the soft and wbf methods change 
+        the scores and boxes respectively.
+        
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=float)
+    n = len(boxes)
+    
+    i, j, ious = box_ious(boxes, labels=labels)
+    
+    if method in ('greedy', 'wbf'):
+        above = ious > thr
+        indptr, indices, _ = _neighbour_lists(n, i[above], j[above], 
+                                              ious[above])
+        
+        order = scores.argsort()[::-1]
+        
+        # Box each box was suppressed by, -1 if kept.
+        owner = np.full(n, -1)
+        suppressed = np.zeros(n, dtype=bool)
+        
+        # Boxes without neighbours are always kept.
+        for k in order[indptr[order + 1] > indptr[order]]:
+            if not suppressed[k]:
+                nbrs = indices[indptr[k]:indptr[k+1]]
+                nbrs = nbrs[~suppressed[nbrs]]
+                
+                suppressed[nbrs] = True
+                owner[nbrs] = k
+                
+        keep = order[~suppressed[order]]
+        
+        if method == 'greedy':
+            return keep, boxes[keep], scores[keep]
+        
+        owner[keep] = keep
+        
+        weights = np.bincount(owner, weights=scores, minlength=n)[keep]
+        counts = np.bincount(owner, minlength=n)[keep]
+        
+        fused = np.column_stack([
+            np.bincount(owner, weights=scores * boxes[:, c], minlength=n)[keep]
+            for c in range(4)
+        ])
+        
+        # Clusters without any score keep the box they were formed around.
+        nonzero = weights > 0
+        fused[nonzero] /= weights[nonzero, None]
+        fused[~nonzero] = boxes[keep[~nonzero]]
+        
+        return keep, fused, weights / counts
+    
+    if method not in ('soft', 'soft-linear'):
+        raise ValueError(f'Unknown NMS method \"{method}\".')
+        
+    if method == 'soft-linear':
+        above = ious > thr
+        i, j, ious = i[above], j[above], ious[above]
+        
+    indptr, indices, values = _neighbour_lists(n, i, j, ious)
+    
+    scores = scores.copy()
+    done = np.zeros(n, dtype=bool)
+    keep = []
+    
+    # Boxes without neighbours keep their score.
+    isolated = np.flatnonzero(indptr[1:] == indptr[:-1])
+    isolated = isolated[scores[isolated] >= score_thr]
+    
+    # Max heap of scores, entries of boxes whose score has since decayed are
+    # skipped.
+    heap = [(-scores[k], k) for k in np.flatnonzero(indptr[1:] > indptr[:-1])]
+    heapq.heapify(heap)
+    
+    while heap:
+        s, k = heapq.heappop(heap)
+        
+        if done[k] or -s != scores[k]:
+            continue
+        
+        done[k] = True
+        
+        if scores[k] < score_thr:
+            continue
+        
+        keep.append(k)
+        
+        nbrs = indices[indptr[k]:indptr[k+1]]
+        nbr_ious = values[indptr[k]:indptr[k+1]]
+        nbr_ious, nbrs = nbr_ious[~done[nbrs]], nbrs[~done[nbrs]]
+        
+        if method == 'soft':
+            scores[nbrs] *= np.exp(-nbr_ious ** 2 / sigma)
+        else:
+            scores[nbrs] *= 1 - nbr_ious
+            
+        for nbr in nbrs:
+            heapq.heappush(heap, (-scores[nbr], nbr))
+            
+    keep = np.concatenate([np.array(keep, dtype=int), isolated])
+    keep = keep[np.argsort(-scores[keep], kind='stable')]
+    
+    return keep, boxes[keep], scores[keep]
+
+
+def non_max_suppression(df, thr, method='greedy', agnostic=True):
     """Apply non-max suppression (nms) on a set of prediction boxes. 
     Source: https://github.com/rbgirshick/fast-rcnn/blob/master/lib/utils/nms.py
     
@@ -133,6 +545,10 @@ def non_max_suppression(df, thr):
         right of box
     thr : float
         IoU threshold used for nms
+    method : str
+        nms method, see batched_nms
+    agnostic : bool
+        if False boxes only suppress boxes with the same value in the label column
     
     RETURN
     ------
@@ -141,34 +557,82 @@ def non_max_suppression(df, thr):
     
     """
     df = df.reset_index(drop=True)  # indices must be reset
-    dets = df[['x1', 'y1', 'x2', 'y2', 'conf']].to_numpy()
-    x1 = dets[:, 0]
-    y1 = dets[:, 1]
-    x2 = dets[:, 2]
-    y2 = dets[:, 3]
-    scores = dets[:, 4]
-
-    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-    order = scores.argsort()[::-1]
-
-    keep = []
-    while order.size > 0:
-        i = order[0]
-        keep.append(i)
-        xx1 = np.maximum(x1[i], x1[order[1:]])
-        yy1 = np.maximum(y1[i], y1[order[1:]])
-        xx2 = np.minimum(x2[i], x2[order[1:]])
-        yy2 = np.minimum(y2[i], y2[order[1:]])
+    
+    keep, boxes, scores = batched_nms(
+        df[['x1', 'y1', 'x2', 'y2']].to_numpy(), df['conf'].to_numpy(), 
+        labels=None if agnostic else df['label'].to_numpy(), thr=thr, 
+        method=method
+    )
+    
+    df = df.loc[keep]
+    
+    if method != 'greedy':
+        df = df.copy()
+        df['conf'] = scores
+        
+        if method == 'wbf':
+            df[['x1', 'y1', 'x2', 'y2']] = boxes
+            
+            if 'geometry' in df.columns:
+                df['geometry'] = [
+                    corners_to_polygon(*box) for box in df[
+                        ['x1', 'y1', 'x2', 'y2']
+                    ].to_numpy()
+                ]
+        
+    return df
 
-        w = np.maximum(0.0, xx2 - xx1 + 1)
-        h = np.maximum(0.0, yy2 - yy1 + 1)
-        inter = w * h
-        ovr = inter / (areas[i] + areas[order[1:]] - inter)
 
-        inds = np.where(ovr <= thr)[0]
-        order = order[inds + 1]
+def contained_boxes(boxes: np.ndarray, thr: float) -> np.ndarray:
+    """Find boxes contained, or mostly contained, in other boxes. Boxes are 
+    processed in order and each box that was not removed yet removes the 
+    boxes with more than a fraction thr of their area inside it.
+    
+    Args:
+        boxes: [N, 4] array of boxes in (x1, y1, x2, y2) format.
+        thr: Fraction of a box's area that must be inside another box for it
+            to be removed.
+            
+    Returns:
+        Boolean array of the boxes removed.
         
-    return df.loc[keep]
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    removed = np.zeros(len(boxes), dtype=bool)
+    
+    i, j = box_overlap_pairs(boxes)
+    
+    if not len(i):
+        return removed
+    
+    w = np.minimum(boxes[i, 2], boxes[j, 2]) - \
+        np.maximum(boxes[i, 0], boxes[j, 0])
+    h = np.minimum(boxes[i, 3], boxes[j, 3]) - \
+        np.maximum(boxes[i, 1], boxes[j, 1])
+    inter = w * h
+    
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    
+    # Boxes without area are never removed.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        i_contains_j = inter / areas[j] > thr
+        j_contains_i = inter / areas[i] > thr
+    
+    # Directed edges from each box to the boxes it would remove.
+    src = np.concatenate([i[i_contains_j], j[j_contains_i]])
+    dst = np.concatenate([j[i_contains_j], i[j_contains_i]])
+    
+    order = np.argsort(src, kind='stable')
+    src, dst = src[order], dst[order]
+    
+    sources, starts = np.unique(src, return_index=True)
+    ends = np.append(starts[1:], len(src))
+    
+    for k, start, end in zip(sources, starts, ends):
+        if not removed[k]:
+            removed[dst[start:end]] = True
+            
+    return removed
 
 
 def remove_contained_boxes(df, thr):
@@ -176,36 +640,18 @@ def remove_contained_boxes(df, thr):
     
     INPUTS
     ------
-    df : geodataframe
-        info about each box
+    df : dataframe
+        info about each box, must contain the x1, y1, x2, y2 columns with point 1 being top left of the box and point 2 
+        the bottom right of the box
     thr : float
         the threshold of the box that must be contained by fraction of area to be remove
        
     RETURNS
     -------
-    df : geodataframe
+    df : dataframe
         the boxes that are left
     
     """
-    rm_idx = []
-    
-    gseries = GeoSeries(df.geometry.tolist(), index=df.index.tolist())  # convert to a geoseries
+    removed = contained_boxes(df[['x1', 'y1', 'x2', 'y2']].to_numpy(), thr)
     
-    for i, geo in gseries.items():
-        # don't check boxes that have already been removed
-        if i not in rm_idx:
-            r = df.loc[i]
-            
-            # remove boxes that don't overlap
-            overlapping = df[
-                (~df.index.isin(rm_idx + [i])) & ~((r.y2 < df.y1) | (r.y1 > df.y2) | (r.x2 < df.x1) | (r.x1 > df.x2))
-            ]
-            
-            perc_overlap = overlapping.intersection(geo).area / overlapping.area  # percent of object inside the current geo
-            
-            # filter by the threshold
-            overlapping = overlapping[perc_overlap > thr]
-            
-            rm_idx.extend(overlapping.index.tolist())
-            
-    return df.drop(index=rm_idx)
+    return df[~removed]
@@ -1 +1,2 @@
 from .wsi_inference import wsi_inference
+from .detections import Detections
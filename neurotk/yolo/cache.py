@@ -0,0 +1,64 @@
+"""Hashes used to key cached whole slide inference results."""
+from typing import Union
+import hashlib
+import torch.nn as nn
+
+from os.path import getsize
+
+
+def file_hash(fp: str, chunk_size: int = 2**20, full: bool = False) -> str:
+    """Hash the contents of a file. By default only the file size and the
+    first and last chunks are hashed, which is fast for multi-gigabyte whole
+    slide images but does not tell apart files of the same size that only 
+    differ in between, e.g. re-exports of a slide.
+
+    Args:
+        fp (str): Filepath.
+        chunk_size (int): Size of the chunks read, in bytes.
+        full (bool): Hash the entire file instead.
+
+    Returns:
+        (str) Hex digest.
+
+    """
+    size = getsize(fp)
+    sha = hashlib.sha1(str(size).encode())
+
+    with open(fp, 'rb') as fh:
+        if full or size <= 2 * chunk_size:
+            for chunk in iter(lambda: fh.read(chunk_size), b''):
+                sha.update(chunk)
+        else:
+            sha.update(fh.read(chunk_size))
+            fh.seek(-chunk_size, 2)
+            sha.update(fh.read(chunk_size))
+
+    return sha.hexdigest()
+
+
+def model_hash(model: Union[nn.Module, str]) -> str:
+    """Hash the weights of a model.
+
+    Args:
+        model (torch.nn.Module | str): Model, or filepath to its weights.
+            Models loaded from a weights file (i.e. YOLO models with a
+            ckpt_path) hash the file, otherwise the parameters and buffers
+            are hashed.
+
+    Returns:
+        (str) Hex digest.
+
+    """
+    if isinstance(model, str):
+        return file_hash(model, full=True)
+
+    if getattr(model, 'ckpt_path', None):
+        return file_hash(model.ckpt_path, full=True)
+
+    sha = hashlib.sha1()
+
+    for name, tensor in model.state_dict().items():
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+
+    return sha.hexdigest()
@@ -0,0 +1,127 @@
+"""Checkpoint of tiles processed during whole slide inference."""
+from typing import Tuple
+import numpy as np
+import json
+from glob import glob
+
+from os import makedirs, remove, replace
+from os.path import join, isfile
+
+
+class TileCheckpoint:
+    """Append-only checkpoint of processed tiles and their raw detections.
+    Each flush writes a new NPZ shard to the checkpoint directory, so a
+    process killed mid-run loses at most the tiles since the last flush.
+
+    Args:
+        directory (str): Directory to save the shards to, created if needed.
+        params (dict): JSON serializable parameters the detections depend on.
+            If the directory has shards from a run with different parameters
+            they are deleted.
+        flush_every (int): Number of tiles added between automatic flushes.
+        name (str): Prefix of the shard numbers written by this instance, lets
+            multiple processes write to the same checkpoint directory.
+
+    """
+    def __init__(
+        self, directory: str, params: dict, flush_every: int = 100, 
+        name: str = ''
+    ):
+        self.directory = directory
+        self.flush_every = flush_every
+        self.name = name
+
+        makedirs(directory, exist_ok=True)
+
+        params_fp = join(directory, 'params.json')
+        params = json.loads(json.dumps(params))
+        self.params = params
+
+        if isfile(params_fp):
+            with open(params_fp, 'r') as fh:
+                saved_params = json.load(fh)
+        else:
+            saved_params = None
+
+        if saved_params != params:
+            # Shards from a run with other parameters can't be reused.
+            for fp in self._shard_fps():
+                remove(fp)
+
+            with open(params_fp, 'w') as fh:
+                json.dump(params, fh)
+
+        self._tiles = []
+        self._rows = []
+
+    def _shard_fps(self, own: bool = False):
+        # Own shards match the 6 digit counter exactly, so an unprefixed
+        # instance does not match the shards of prefixed instances.
+        pattern = f'shard-{self.name}{"[0-9]" * 6}.npz' if own else \
+            'shard-*.npz'
+
+        return sorted(glob(join(self.directory, pattern)))
+
+    def load(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Load the checkpointed tiles.
+
+        Returns:
+            (numpy.ndarray) [M, 2] x, y coordinates of the processed tiles, the
+            [M] number of detections in each tile, and the [K, 6] detections
+            of all the tiles in the same order.
+
+        """
+        tiles = [np.empty((0, 2), dtype=int)]
+        counts = [np.empty(0, dtype=int)]
+        rows = [np.empty((0, 6))]
+
+        for fp in self._shard_fps():
+            with np.load(fp) as shard:
+                tiles.append(shard['tiles'])
+                counts.append(shard['counts'])
+                rows.append(shard['detections'])
+
+        return np.concatenate(tiles), np.concatenate(counts), \
+            np.concatenate(rows)
+
+    def add(self, xy: Tuple[int, int], rows: np.ndarray):
+        """Add a processed tile and its detections, flushing if needed.
+
+        Args:
+            xy (Tuple[int, int]): Top left coordinate of the tile.
+            rows (numpy.ndarray): [N, 6] detections of the tile, can be empty.
+
+        """
+        self._tiles.append(xy)
+        self._rows.append(np.asarray(rows, dtype=float).reshape(-1, 6))
+
+        if len(self._tiles) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Write the tiles added since the last flush to a new shard."""
+        if not self._tiles:
+            return
+
+        counters = [int(fp[-10:-4]) for fp in self._shard_fps(own=True)]
+        n = max(counters) + 1 if counters else 0
+        fp = join(self.directory, f'shard-{self.name}{n:06d}.npz')
+
+        # Never overwrite an existing shard.
+        while isfile(fp):
+            n += 1
+            fp = join(self.directory, f'shard-{self.name}{n:06d}.npz')
+
+        # Write to a temporary file first so partial shards are never read.
+        tmp_fp = join(self.directory, f'tmp-{self.name}{n:06d}.npz')
+
+        np.savez(
+            tmp_fp,
+            tiles=np.array(self._tiles, dtype=int).reshape(-1, 2),
+            counts=np.array([len(r) for r in self._rows], dtype=int),
+            detections=np.concatenate(self._rows)
+        )
+        replace(tmp_fp, fp)
+
+        self._tiles = []
+        self._rows = []
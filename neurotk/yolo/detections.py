@@ -0,0 +1,130 @@
+"""Columnar container for box predictions."""
+from typing import Optional, Union
+import numpy as np
+from pandas import DataFrame
+from geopandas import GeoDataFrame
+import shapely
+
+
+class Detections:
+    """Box predictions stored in a preallocated NumPy array that grows as
+    rows are appended. Each row is (label, x1, y1, x2, y2, conf) with point 1
+    being the top left corner and point 2 the bottom right corner of the box.
+    Geometries are only created when converting to a GeoDataFrame.
+
+    Args:
+        data (numpy.ndarray): Optional [N, 6] array of initial rows.
+        capacity (int): Number of rows to preallocate.
+
+    Attributes:
+        attrs (dict): Metadata about the predictions, copied to the attrs of
+            the dataframes created from it.
+
+    """
+    columns = ('label', 'x1', 'y1', 'x2', 'y2', 'conf')
+
+    def __init__(
+        self, data: Optional[np.ndarray] = None, capacity: int = 1024
+    ):
+        if data is None:
+            self._data = np.empty((capacity, len(self.columns)), dtype=float)
+            self._n = 0
+        else:
+            self._data = np.array(data, dtype=float).reshape(
+                -1, len(self.columns)
+            )
+            self._n = len(self._data)
+
+        self.attrs = {}
+
+    def __len__(self) -> int:
+        return self._n
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.data[:, self.columns.index(column)]
+
+    @property
+    def data(self) -> np.ndarray:
+        """View of the [N, 6] array of rows."""
+        return self._data[:self._n]
+
+    @property
+    def boxes(self) -> np.ndarray:
+        """View of the [N, 4] array of (x1, y1, x2, y2) coordinates."""
+        return self.data[:, 1:5]
+
+    def append(self, rows: Union[np.ndarray, list]):
+        """Append one or more rows, growing the array if needed.
+
+        Args:
+            rows (numpy.ndarray | list): Row or [N, 6] rows to append.
+
+        """
+        rows = np.asarray(rows, dtype=float).reshape(-1, len(self.columns))
+        n = self._n + len(rows)
+
+        if n > len(self._data):
+            # Grow by doubling to amortize the copies.
+            data = np.empty(
+                (max(n, 2 * len(self._data)), len(self.columns)), dtype=float
+            )
+            data[:self._n] = self.data
+            self._data = data
+
+        self._data[self._n:n] = rows
+        self._n = n
+
+    def subset(self, idx: np.ndarray) -> 'Detections':
+        """Get a copy with only some rows.
+
+        Args:
+            idx (numpy.ndarray): Indices or boolean mask of rows to keep.
+
+        Returns:
+            New detections with the selected rows.
+
+        """
+        detections = Detections(self.data[idx])
+        detections.attrs = dict(self.attrs)
+
+        return detections
+
+    def to_dataframe(self) -> DataFrame:
+        """Convert to a DataFrame with a label, x1, y1, x2, y2, conf and
+        box_area columns, without geometries.
+
+        """
+        data = self.data
+        coords = data[:, 1:5].astype(int)
+
+        df = DataFrame({
+            'label': data[:, 0].astype(int),
+            'x1': coords[:, 0],
+            'y1': coords[:, 1],
+            'x2': coords[:, 2],
+            'y2': coords[:, 3],
+            'conf': data[:, 5],
+            'box_area': (coords[:, 2] - coords[:, 0]) * \
+                (coords[:, 3] - coords[:, 1])
+        })
+        df.attrs = dict(self.attrs)
+
+        return df
+
+    def to_geodataframe(self) -> GeoDataFrame:
+        """Convert to a GeoDataFrame, with the box polygons as the geometry
+        created in a single vectorized call.
+
+        """
+        df = self.to_dataframe()
+
+        geometry = shapely.box(
+            df['x1'].to_numpy(), df['y1'].to_numpy(), df['x2'].to_numpy(),
+            df['y2'].to_numpy()
+        )
+        df.insert(6, 'geometry', geometry)
+
+        gdf = GeoDataFrame(df, geometry='geometry')
+        gdf.attrs = dict(self.attrs)
+
+        return gdf
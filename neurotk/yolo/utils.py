@@ -1,6 +1,10 @@
-from typing import Union, Tuple
+from typing import Union, Tuple, Optional, List
+from functools import lru_cache
 import numpy as np
 import torch
+import cv2 as cv
+import shapely
+from shapely.geometry.base import BaseGeometry
 
 
 def convert_box_type(box: np.ndarray) -> np.ndarray:
@@ -94,8 +98,10 @@ def read_yolo_label(
     return coords
 
 
+@lru_cache(maxsize=None)
 def get_devices(device=None):
-    """Get the number of GPU devices, if available. 
+    """Get the number of GPU devices, if available. Results are cached, so 
+    CUDA is only probed once per process.
     
     INPUTS
     ------
@@ -125,3 +131,295 @@ def get_devices(device=None):
         n_devices = len(device.split(','))
         
     return device, n_devices
+
+
+def integral_box_sums(
+    integral: np.ndarray, x1: np.ndarray, y1: np.ndarray, x2: np.ndarray, 
+    y2: np.ndarray
+) -> np.ndarray:
+    """Sum of the values inside many boxes of an image at once, using its 
+    integral image. Boxes are clipped to the image.
+    
+    Args:
+        integral (numpy.ndarray): Integral image of shape (height + 1, 
+            width + 1), with a leading row and column of zeros as returned by
+            cv.integral.
+        x1, y1, x2, y2 (numpy.ndarray): Box coordinates, point 2 exclusive.
+        
+    Returns:
+        (numpy.ndarray) Sum of each box.
+    
+    """
+    h, w = integral.shape[0] - 1, integral.shape[1] - 1
+    
+    x1, x2 = np.clip(x1, 0, w), np.clip(x2, 0, w)
+    y1, y2 = np.clip(y1, 0, h), np.clip(y2, 0, h)
+    
+    return integral[y2, x2] - integral[y1, x2] - integral[y2, x1] + \
+        integral[y1, x1]
+
+
+def tile_coordinates(
+    width: int, height: int, stride: int, tile_size: int, 
+    mask: Optional[np.ndarray] = None, fr_to_mask: Optional[float] = None,
+    mask_thr: float = 0.0, mask_offset: Tuple[int, int] = (0, 0)
+) -> np.ndarray:
+    """Get the top left coordinates of tiles covering an image, optionally 
+    keeping only tiles with enough of their area inside a low resolution mask.
+    The fraction of each tile in the mask is calculated for all tiles at once
+    using an integral image of the mask.
+    
+    Args:
+        width (int): Width of the image.
+        height (int): Height of the image.
+        stride (int): Stride between tiles.
+        tile_size (int): Size of the tiles.
+        mask (numpy.ndarray): Optional low resolution binary mask, non-zero 
+            values are inside the mask.
+        fr_to_mask (float): Multiplicative factor going from image coordinates
+            to mask coordinates, required when mask is given.
+        mask_thr (float): Fraction of tile that must be in mask to be kept.
+        mask_offset (Tuple[int, int]): x, y position of the mask's top left 
+            corner in a mask of the whole image, for masks cropped to a 
+            region. Only tiles overlapping the mask are enumerated.
+        
+    Returns:
+        (np.ndarray) [N, 5] array with x, y, mask x, mask y and fraction of 
+        the tile in the mask. Mask coordinates are in the mask of the whole
+        image. Tiles are ordered row by row. If no mask is given the mask 
+        coordinates are -1 and the fractions are 1.
+        
+    Raises:
+        ValueError if the tiles are smaller than a mask pixel.
+    
+    """
+    xs = np.arange(0, width, stride)
+    ys = np.arange(0, height, stride)
+    
+    if mask is None:
+        ys, xs = np.meshgrid(ys, xs, indexing='ij')
+        xs, ys = xs.ravel(), ys.ravel()
+        
+        return np.column_stack([
+            xs, ys, np.full(len(xs), -1), np.full(len(xs), -1), 
+            np.ones(len(xs))
+        ]).astype(float)
+    
+    mask_h, mask_w = mask.shape[:2]
+    mask_tile_size = int(tile_size * fr_to_mask)
+    offset_x, offset_y = mask_offset
+    
+    if mask_tile_size < 1:
+        raise ValueError(
+            'Tiles are smaller than a mask pixel, use a higher resolution '
+            'mask or larger tiles.'
+        )
+    
+    # Only rows and columns of tiles that overlap the mask can be in it.
+    mask_xs = (xs * fr_to_mask).astype(int)
+    mask_ys = (ys * fr_to_mask).astype(int)
+    
+    cols = (mask_xs + mask_tile_size > offset_x) & \
+        (mask_xs < offset_x + mask_w)
+    rows = (mask_ys + mask_tile_size > offset_y) & \
+        (mask_ys < offset_y + mask_h)
+    
+    ys, xs = np.meshgrid(ys[rows], xs[cols], indexing='ij')
+    mask_ys, mask_xs = np.meshgrid(mask_ys[rows], mask_xs[cols], indexing='ij')
+    xs, ys = xs.ravel(), ys.ravel()
+    mask_xs, mask_ys = mask_xs.ravel(), mask_ys.ravel()
+    
+    # Integral image, padded with a leading row and column of zeros.
+    integral = np.zeros((mask_h + 1, mask_w + 1), dtype=np.int32)
+    np.cumsum(
+        np.cumsum(mask != 0, axis=0, dtype=np.int32), axis=1, 
+        out=integral[1:, 1:]
+    )
+    
+    # Tiles are clipped at the mask edges, the mask is empty outside them.
+    counts = integral_box_sums(
+        integral, mask_xs - offset_x, mask_ys - offset_y, 
+        mask_xs - offset_x + mask_tile_size, 
+        mask_ys - offset_y + mask_tile_size
+    )
+    
+    fracs = counts / mask_tile_size ** 2
+    
+    keep = fracs > mask_thr
+    
+    return np.column_stack([
+        xs[keep], ys[keep], mask_xs[keep], mask_ys[keep], fracs[keep]
+    ]).astype(float)
+
+
+@lru_cache(maxsize=None)
+def load_yolo(weights: str):
+    """Load a YOLO model, cached so that processing many images in the same
+    process loads the weights only once.
+    
+    Args:
+        weights (str): Filepath to the YOLO weights.
+        
+    Returns:
+        (ultralytics.YOLO) Model.
+        
+    """
+    from ultralytics import YOLO
+    
+    return YOLO(weights)
+
+
+def polygon_tile_coordinates(
+    geometry: BaseGeometry, width: int, height: int, stride: int, 
+    tile_size: int, mask_thr: float = 0.0
+) -> np.ndarray:
+    """Get the top left coordinates of tiles covering the polygons of a 
+    region, with the exact fraction of each tile inside them. Each row of 
+    tiles is intersected with the polygons first and only the tiles within 
+    the extent of that strip are checked, so the work scales with the size 
+    of the region rather than the image.
+    
+    Args:
+        geometry (shapely.geometry.base.BaseGeometry): Polygon or 
+            multipolygon in image coordinates.
+        width (int): Width of the image.
+        height (int): Height of the image.
+        stride (int): Stride between tiles.
+        tile_size (int): Size of the tiles.
+        mask_thr (float): Fraction of tile that must be in the polygons to be
+            kept.
+        
+    Returns:
+        (np.ndarray) [N, 5] array with x, y, mask x, mask y and fraction of 
+        the tile in the polygons, in the same format as tile_coordinates. The
+        mask coordinates are -1. Tiles are ordered row by row.
+    
+    """
+    xs = np.arange(0, width, stride)
+    ys = np.arange(0, height, stride)
+    
+    # Parts of the polygons outside the image are not analyzed.
+    geometry = shapely.intersection(geometry, shapely.box(0, 0, width, height))
+    
+    tiles = [np.empty((0, 5))]
+    
+    if geometry.is_empty:
+        return tiles[0]
+    
+    minx, miny, maxx, maxy = geometry.bounds
+    
+    for y in ys[(ys + tile_size > miny) & (ys < maxy)]:
+        strip = shapely.intersection(
+            geometry, shapely.box(minx, y, maxx, y + tile_size)
+        )
+        
+        if strip.is_empty:
+            continue
+        
+        strip_x1, _, strip_x2, _ = strip.bounds
+        
+        cols = xs[(xs + tile_size > strip_x1) & (xs < strip_x2)]
+        
+        fracs = shapely.area(shapely.intersection(
+            strip, shapely.box(cols, y, cols + tile_size, y + tile_size)
+        )) / tile_size ** 2
+        
+        keep = fracs > mask_thr
+        
+        tiles.append(np.column_stack([
+            cols[keep], np.full(keep.sum(), y), np.full(keep.sum(), -1), 
+            np.full(keep.sum(), -1), fracs[keep]
+        ]))
+        
+    return np.concatenate(tiles).astype(float)
+
+
+def tile_statistics(
+    img: np.ndarray, xs: np.ndarray, ys: np.ndarray, tile_size: int, 
+    fr_to_img: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Intensity and saturation statistics of many tiles at once, computed 
+    on a low resolution image of the whole slide with integral images.
+    
+    Args:
+        img (numpy.ndarray): Low resolution RGB or single channel image.
+        xs, ys (numpy.ndarray): Top left coordinates of the tiles.
+        tile_size (int): Size of the tiles.
+        fr_to_img (float): Multiplicative factor going from tile coordinates
+            to low resolution image coordinates.
+            
+    Returns:
+        (numpy.ndarray) Mean and standard deviation of the grayscale 
+        intensity, and mean saturation (0 for single channel images), of the
+        part of each tile inside the image.
+    
+    """
+    if img.ndim == 2 or img.shape[2] == 1:
+        gray = img.reshape(img.shape[:2])
+        sat = None
+    else:
+        gray = cv.cvtColor(img[:, :, :3], cv.COLOR_RGB2GRAY)
+        sat = cv.cvtColor(img[:, :, :3], cv.COLOR_RGB2HSV)[:, :, 1]
+        
+    x1 = (xs * fr_to_img).astype(int)
+    y1 = (ys * fr_to_img).astype(int)
+    x2 = x1 + max(1, int(tile_size * fr_to_img))
+    y2 = y1 + max(1, int(tile_size * fr_to_img))
+    
+    # Number of low resolution pixels in each tile.
+    area = (np.clip(x2, 0, gray.shape[1]) - np.clip(x1, 0, gray.shape[1])) * \
+        (np.clip(y2, 0, gray.shape[0]) - np.clip(y1, 0, gray.shape[0]))
+    area = np.maximum(area, 1)
+    
+    sums, sq_sums = cv.integral2(gray, sdepth=cv.CV_64F)
+    
+    mean = integral_box_sums(sums, x1, y1, x2, y2) / area
+    var = integral_box_sums(sq_sums, x1, y1, x2, y2) / area - mean ** 2
+    std = np.sqrt(np.maximum(var, 0))
+    
+    if sat is None:
+        saturation = np.zeros(len(xs))
+    else:
+        saturation = integral_box_sums(
+            cv.integral(sat, sdepth=cv.CV_64F), x1, y1, x2, y2
+        ) / area
+    
+    return mean, std, saturation
+
+
+def stored_downsamples(ts) -> Optional[List[float]]:
+    """Downsample factors, from full resolution, of the pyramid levels that 
+    are stored in an image. large_image reports a level for every power of 
+    two, but levels missing from the file are resampled from the next stored
+    level, so the stored levels are taken from the tile source's internal 
+    metadata.
+    
+    Args:
+        ts: Large image tile source.
+        
+    Returns:
+        (list) Downsample factors of the stored levels in increasing order, 
+        starting with 1 for full resolution, or None if the tile source does
+        not expose its stored levels.
+    
+    """
+    props = (ts.getInternalMetadata() or {}).get('openslide') or {}
+    
+    if 'openslide.level-count' in props:
+        return sorted(
+            float(props[f'openslide.level[{i}].downsample']) 
+            for i in range(int(props['openslide.level-count']))
+        )
+    
+    # Tiff sources keep the directory of each level, None for levels that 
+    # are not stored.
+    directories = getattr(ts, '_tiffDirectories', None)
+    
+    if directories is not None:
+        return sorted(
+            2.0 ** (ts.levels - 1 - level) 
+            for level, directory in enumerate(directories) 
+            if directory is not None
+        )
+        
+    return None
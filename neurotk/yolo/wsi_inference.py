@@ -1,31 +1,396 @@
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Callable, Iterator, List, Sequence, Union
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import get_context
+import torch
 import torch.nn as nn
 import numpy as np
+import hashlib
+import json
 import large_image
 from tqdm import tqdm
 import cv2 as cv
-from shapely.geometry import Polygon
-from geopandas import GeoDataFrame
-from ..utils import non_max_suppression, remove_contained_boxes
+from ..utils import (
+    contained_boxes, batched_nms
+)
+from ..region import polygons_geometry, geometry_rings
+from .utils import (
+    tile_coordinates, polygon_tile_coordinates, tile_statistics, load_yolo,
+    stored_downsamples
+)
+from .detections import Detections
+from .checkpoint import TileCheckpoint
+from .cache import file_hash, model_hash
+
+from os import cpu_count, getpid, stat
+from os.path import abspath, join, realpath
+
+
+def _iter_batches(
+    read_tile: Callable, xys: List, batch_size: int, workers: int = 0,
+    prefetch: int = 2
+) -> Iterator[Tuple[List, List[np.ndarray]]]:
+    """Read tiles in batches, optionally prefetching the next batches in a 
+    thread pool while the current batch is being consumed.
+    
+    Args:
+        read_tile (Callable): Function that takes a tile coordinate entry and 
+            returns the preprocessed tile image.
+        xys (list): Tile coordinate entries.
+        batch_size (int): Number of tiles per batch.
+        workers (int): Number of reader threads. If 0 the tiles are read 
+            serially when the batch is requested.
+        prefetch (int): Maximum number of batches read ahead of the batch being
+            consumed, caps the number of tiles held in memory.
+            
+    Returns:
+        Iterator of (batch coordinates, batch images).
+        
+    """
+    starts = range(0, len(xys), batch_size)
+    
+    if not workers:
+        for i in starts:
+            batch_xys = xys[i:i+batch_size]
+            
+            yield batch_xys, [read_tile(xy) for xy in batch_xys]
+            
+        return
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Bounded queue of batches being read.
+        pending = deque()
+        
+        for i in starts:
+            batch_xys = xys[i:i+batch_size]
+            pending.append(
+                (batch_xys, [pool.submit(read_tile, xy) for xy in batch_xys])
+            )
+            
+            if len(pending) > prefetch:
+                batch_xys, futures = pending.popleft()
+                
+                yield batch_xys, [future.result() for future in futures]
+                
+        while pending:
+            batch_xys, futures = pending.popleft()
+            
+            yield batch_xys, [future.result() for future in futures]
+
+
+def _read_tile(ts, xy: np.ndarray, settings: dict) -> np.ndarray:
+    """Read a tile region and preprocess it for the model."""
+    x, y, tile_x, tile_y = xy[:4].astype(int)
+    tile_frac = xy[4]
+    
+    fr_tile_size = settings['fr_tile_size']
+    tile_size = settings['tile_size']
+    fill = settings['fill']
+    mask = settings['mask']
+    mask_tile_size = settings['mask_tile_size']
+    
+    img = ts.getRegion(
+        region={
+            'left': x, 'top': y, 
+            'right':x + fr_tile_size, 'bottom': y + fr_tile_size
+        },
+        format=large_image.constants.TILE_FORMAT_NUMPY,
+        scale={'magnification': settings['read_mag']},
+        frame=settings['frame']
+    )[0]
+    
+    if settings['resize'] != 1:
+        # Residual resize from the pyramid level to the analysis magnification.
+        h, w = img.shape[:2]
+        size = (
+            max(1, round(w * settings['resize'])), 
+            max(1, round(h * settings['resize']))
+        )
+        
+        img = cv.resize(img, size, interpolation=cv.INTER_AREA)
+        
+        # OpenCV drops the channel axis of single channel images.
+        img = img.reshape(size[1], size[0], -1)[:tile_size, :tile_size]
+    
+    img_shape = img.shape
+                
+    if img_shape[2] == 1:
+        img = cv.cvtColor(img[:, :, 0], cv.COLOR_GRAY2RGB)
+    else:
+        # Convert image to BGR.
+        img = cv.cvtColor(img[:, :, :3], cv.COLOR_RGB2BGR)
+                                        
+    # Pad the image if needed
+    if img_shape[:2] != (tile_size, tile_size):
+        img = cv.copyMakeBorder(
+            img, 0, tile_size - img_shape[0], 0, 
+            tile_size - img_shape[1], cv.BORDER_CONSTANT, None, fill
+        )
+        
+    if mask is not None:
+        if tile_frac < 1:
+            # Mask out region, the tile is cut from a mask of the whole image
+            # which is empty outside the (possibly cropped) mask.
+            offset_x, offset_y = settings['mask_offset']
+            full_h, full_w = settings['mask_shape']
+            
+            mask_tile = np.zeros(
+                (
+                    min(mask_tile_size, full_h - tile_y), 
+                    min(mask_tile_size, full_w - tile_x)
+                ), 
+                dtype=mask.dtype
+            )
+            
+            x1, y1 = max(tile_x, offset_x), max(tile_y, offset_y)
+            x2 = min(tile_x + mask_tile.shape[1], offset_x + mask.shape[1])
+            y2 = min(tile_y + mask_tile.shape[0], offset_y + mask.shape[0])
+            
+            if x2 > x1 and y2 > y1:
+                mask_tile[y1-tile_y:y2-tile_y, x1-tile_x:x2-tile_x] = mask[
+                    y1-offset_y:y2-offset_y, x1-offset_x:x2-offset_x
+                ]
+        
+            # Reshape mask to tile image size.
+            mask_tile = cv.resize(
+                mask_tile.copy(), (tile_size, tile_size), 
+                interpolation=cv.INTER_NEAREST
+            )
+            
+            # Regions outside of mask get set to fill value.
+            img = img.copy()
+            
+            img[mask_tile == 0] = fill
+    elif settings['rings'] is not None and tile_frac < 1:
+        # Rasterize the region's polygons at the tile's resolution.
+        exteriors, interiors = settings['rings']
+        scale = tile_size / fr_tile_size
+        
+        mask_tile = np.zeros((tile_size, tile_size), dtype=np.uint8)
+        
+        # All rings in one call are filled with the even-odd rule, so holes
+        # are cleared and polygons inside other polygons' holes are kept.
+        cv.fillPoly(mask_tile, [
+            np.round((ring - [x, y]) * scale).astype(np.int32)
+            for ring in exteriors + interiors
+        ], 255)
+            
+        img = img.copy()
+        
+        img[mask_tile == 0] = fill
+            
+    return img
+
+
+def _predict_tiles(
+    ts, model: nn.Module, xys: np.ndarray, settings: dict, 
+    store: Optional[TileCheckpoint] = None, progress: bool = True
+) -> Detections:
+    """Predict on tiles in batches, reading ahead while the model predicts.
+    
+    Args:
+        ts: Tile source.
+        model (torch.nn.Module): YOLO model.
+        xys (numpy.ndarray): Tile coordinates from tile_coordinates.
+        settings (dict): Tile reading and prediction settings.
+        store (TileCheckpoint): Optional checkpoint to add the tiles to.
+        progress (bool): Show a progress bar.
+        
+    Returns:
+        (Detections) Raw predictions, in the order of the tiles.
+    
+    """
+    batch_size = settings['batch_size']
+    mag_to_fr = settings['mag_to_fr']
+    
+    detections = Detections()
+    
+    n_batches = len(range(0, len(xys), batch_size))
+    batches = _iter_batches(
+        lambda xy: _read_tile(ts, xy, settings), xys, batch_size, 
+        workers=settings['workers'], prefetch=settings['prefetch']
+    )
+    
+    if progress:
+        print(f'Predicting on tiles for {n_batches} batches.')
+        batches = tqdm(batches, total=n_batches)
+        
+    for batch_xys, imgs in batches:
+        batch_out = model.predict(
+            imgs,
+            device=settings['device'],
+            max_det=settings['max_det'],
+            iou=settings['iou_thr'],
+            conf=settings['conf_thr'],
+            imgsz=settings['tile_size'],
+            verbose=False,
+            stream=True
+        )
+        
+        for xy, out in zip(batch_xys, batch_out):
+            x, y = xy[:2].astype(int)
+            
+            # Move the tile's boxes to host in one go, rows are x1, y1, x2, y2,
+            # (track id), conf, label.
+            boxes = out.boxes.data.cpu().numpy()
+            
+            # Keep the magnification in mind.
+            xyxy = (boxes[:, :4] * mag_to_fr).astype(int) + [x, y, x, y]
+            
+            rows = np.column_stack([boxes[:, -1], xyxy, boxes[:, -2]])
+            
+            detections.append(rows)
+            
+            if store is not None:
+                store.add((x, y), rows)
+                
+    return detections
+
+
+# State of each shard process, set once by _init_shard.
+_shard = {}
+
+
+def _init_shard(
+    fp: str, weights: str, settings: dict, checkpoint: Optional[Tuple],
+    n_threads: int
+):
+    """Open the tile source and load the model once per shard process."""
+    torch.set_num_threads(n_threads)
+    
+    _shard['ts'] = large_image.getTileSource(fp)
+    _shard['model'] = load_yolo(weights)
+    _shard['settings'] = settings
+    
+    if checkpoint is not None:
+        directory, params, flush_every = checkpoint
+        
+        _shard['store'] = TileCheckpoint(
+            directory, params, flush_every=flush_every, name=f'{getpid()}-'
+        )
+    else:
+        _shard['store'] = None
+    
+
+def _predict_shard(xys: np.ndarray) -> np.ndarray:
+    """Predict on a chunk of tiles in a shard process."""
+    detections = _predict_tiles(
+        _shard['ts'], _shard['model'], xys, _shard['settings'], 
+        store=_shard['store'], progress=False
+    )
+    
+    if _shard['store'] is not None:
+        _shard['store'].flush()
+        
+    return detections.data
+
+
+def _predict_sharded(
+    fp: str, model: Union[nn.Module, str], xys: np.ndarray, settings: dict,
+    shards: int, checkpoint: Optional[Tuple] = None
+) -> Detections:
+    """Predict on tiles split across multiple processes, each with its own
+    model and tile source. The tiles are split into chunks, more than there 
+    are processes to balance the load, and the predictions are merged in the
+    order of the tiles so the output does not depend on the number of shards.
+    
+    Args:
+        fp (str): Filepath to image.
+        model (torch.nn.Module | str): YOLO model, must have been loaded from
+            a weights file, or the weights filepath.
+        xys (numpy.ndarray): Tile coordinates from tile_coordinates.
+        settings (dict): Tile reading and prediction settings.
+        shards (int): Number of processes.
+        checkpoint (tuple): Optional checkpoint directory, parameters and 
+            flush frequency, each process writes its own shards to it.
+            
+    Returns:
+        (Detections) Raw predictions, in the order of the tiles.
+        
+    """
+    weights = model if isinstance(model, str) else \
+        getattr(model, 'ckpt_path', None)
+    
+    if weights is None:
+        raise ValueError(
+            'Sharded inference needs a model loaded from a weights file.'
+        )
+        
+    chunks = [
+        chunk for chunk in np.array_split(xys, shards * 4) if len(chunk)
+    ]
+    
+    detections = Detections()
+    
+    print(f'Predicting on {len(xys)} tiles with {shards} shards.')
+    with ProcessPoolExecutor(
+        max_workers=shards, mp_context=get_context('spawn'),
+        initializer=_init_shard,
+        initargs=(
+            fp, weights, settings, checkpoint, 
+            max(1, cpu_count() // shards)
+        )
+    ) as pool:
+        for rows in tqdm(pool.map(_predict_shard, chunks), total=len(chunks)):
+            detections.append(rows)
+            
+    return detections
+
+
+def _merge_predictions(
+    detections: Detections, iou_thr: float, contained_thr: float, 
+    nms_method: str = 'greedy', agnostic_nms: bool = False, 
+    conf_thr: float = 0.0
+) -> Detections:
+    """Merge predictions from overlapping tiles with non-max suppression and
+    removal of contained boxes. Both steps use a spatial index so boxes are
+    only compared with the boxes they overlap, which mostly happens in the 
+    tile overlap bands.
+    
+    """
+    keep, boxes, scores = batched_nms(
+        detections.boxes.astype(int), detections['conf'], 
+        labels=None if agnostic_nms else detections['label'], thr=iou_thr,
+        method=nms_method, score_thr=conf_thr
+    )
+    
+    detections = detections.subset(keep)
+    detections.data[:, 1:5] = boxes
+    detections.data[:, 5] = scores
+    
+    return detections.subset(
+        ~contained_boxes(detections.boxes.astype(int), contained_thr)
+    )
 
 
 def wsi_inference(
-    fp: str, model: nn.Module, mask: Optional[np.ndarray] = None, 
+    fp: str, model: Union[nn.Module, str], mask: Optional[np.ndarray] = None, 
     frame: Optional[int] = None, mag: Optional[float] = None,
     tile_size: int = 1280, stride: int = 960, batch_size: int = 10,
     device: str = 'cpu', max_det: int = 1000, iou_thr: float = 0.6, 
     conf_thr: float = 0.5, fill: Tuple[int, int, int] = (255, 255, 255),
-    contained_thr: float = 0.8, mask_thr: float = (0.2)
+    contained_thr: float = 0.8, mask_thr: float = (0.2), workers: int = 0,
+    prefetch: int = 2, as_gdf: bool = True, checkpoint: Optional[str] = None,
+    checkpoint_every: int = 100, shards: int = 1, native_level: bool = False,
+    blank_std_thr: Optional[float] = None, 
+    blank_sat_thr: Optional[float] = None, blank_mag: float = 1.25,
+    cache_dir: Optional[str] = None, cache_conf: float = 0.01,
+    nms_method: str = 'greedy', agnostic_nms: bool = False,
+    mask_offset: Tuple[int, int] = (0, 0), mask_scale: Optional[float] = None,
+    polygons: Optional[Sequence[np.ndarray]] = None
 ):
     """Inference a YOLO model on a large image by tiling it into smaller 
     overlapping regions and then merging predictions.
     
     Args:
         fp (str): Filepath to image, must be openable by large_image.
-        model (torch.nn.Module): Model used to predict labels.
+        model (torch.nn.Module | str): Model used to predict labels. When 
+            using shards it can also be the filepath to the YOLO weights.
         mask (numpy.ndarray): Optional low resolution mask used to narrow
             down the regions to analyze in the image. If None then the entire
-            image is analyzed.
+            image is analyzed. Can be cropped to the region analyzed (see 
+            neurotk.region.region_mask), then only tiles overlapping it are 
+            enumerated.
         frame (int): Optional frame of multiplex image to analyze.
         mag (int): Optional magnification to analyze images at.
         tile_size (int): Tile size.
@@ -41,6 +406,80 @@ def wsi_inference(
             analyzed.
         mask_thr (float): Fraction of tile that must be in mask to be predicted
             on.
+        workers (int): Number of threads reading and preprocessing tiles 
+            while the model predicts on the current batch. If 0, tiles are 
+            read serially before each batch is predicted.
+        prefetch (int): Maximum number of batches read ahead when using 
+            workers, bounds the memory used by tiles waiting to be predicted.
+        as_gdf (bool): If True return the predictions as a GeoDataFrame with 
+            box geometries, otherwise return the Detections without building 
+            geometries.
+        checkpoint (str): Optional directory to periodically save the tiles 
+            processed and their raw detections to. Rerunning with the same 
+            parameters skips the tiles already in the checkpoint.
+        checkpoint_every (int): Number of tiles processed between checkpoint
+            saves.
+        shards (int): Number of processes to split the tiles across, each 
+            with its own model and tile source. Meant for CPU only workers,
+            the torch threads are split evenly between the processes. The 
+            predictions are merged in the order of the tiles, so the output 
+            is deterministic.
+        native_level (bool): When analyzing at a lower magnification than 
+            the scan, read tiles from the closest pyramid level stored in the
+            image at or above the magnification (see 
+            neurotk.yolo.utils.stored_downsamples) and resize them with 
+            cv.INTER_AREA, instead of letting the tile source resample them 
+            from the next stored level. Decodes fewer pixels when the 
+            magnification falls between stored levels, but the resampling 
+            differs from large_image's so the tiles are not identical. 
+            Ignored if the stored levels are unknown.
+        blank_std_thr (float): Optional fast reject of blank tiles, tiles whose
+            grayscale standard deviation on a low resolution read of the 
+            image is below this value are skipped without running the model.
+            In the intensity range of the image's dtype.
+        blank_sat_thr (float): Optional fast reject of unstained tiles, tiles 
+            whose mean saturation (0 - 255) on the low resolution read is 
+            below this value are skipped. Ignored for single channel images.
+        blank_mag (float): Magnification of the low resolution read used to
+            reject tiles.
+        cache_dir (str): Optional directory of cached raw tile predictions. 
+            Tiles are predicted at cache_conf and cached under a key from the
+            image and model weights hashes and the tiling parameters, so runs
+            that only change conf_thr, contained_thr or mask_thr reuse them.
+            The image hash (neurotk.yolo.cache.file_hash) only covers the
+            file size and its first and last MiB, so the key also has the 
+            image's resolved path and modification time. Moving or touching 
+            the image predicts its tiles again. Takes the place of checkpoint
+            when given.
+        cache_conf (float): Confidence threshold tiles are predicted at when 
+            caching, predictions are then filtered with conf_thr. If conf_thr
+            is lower, tiles are predicted and cached at conf_thr instead,
+            under a separate key.
+        nms_method (str): Method used to merge overlapping predictions from
+            neighbouring tiles, 'greedy', 'soft', 'soft-linear' or 'wbf'. See
+            neurotk.utils.batched_nms.
+        agnostic_nms (bool): If True boxes can suppress boxes of other labels
+            when merging tiles, as before class aware merging was added. The 
+            NMS within each tile is always class aware.
+        mask_offset (Tuple[int, int]): x, y position of the top left corner 
+            of a cropped mask in a mask of the whole image.
+        mask_scale (float): Multiplicative factor from full resolution to 
+            mask coordinates. Required for cropped masks, if None it is 
+            calculated from the height of the mask, which must then cover the
+            whole image.
+        polygons (Sequence[numpy.ndarray]): Optional [M, 2] x, y vertices of
+            the polygons of the region to analyze, in full resolution 
+            coordinates (see neurotk.region.region_polygons). Used instead of
+            a mask, tiles are selected with their exact fraction inside the
+            polygons and masked by rasterizing the polygons at the tile's 
+            resolution.
+            
+    Returns:
+        (geopandas.GeoDataFrame | Detections) Predictions with label, x1, y1, 
+        x2, y2 and conf columns. The attrs have the number of tiles in the 
+        analysis region ('total'), skipped as blank ('skipped'), restored 
+        from a checkpoint ('restored') and predicted on ('processed') under 
+        'tiles'.
             
     """
     # Get image tilesource, currently throwing warnings for these images.
@@ -59,142 +498,233 @@ def wsi_inference(
         mag_to_fr = 1
         fr_tile_size, fr_stride = tile_size, stride
         
+    read_mag, resize = mag, 1
+    
+    if native_level and mag_to_fr > 1:
+        downsamples = stored_downsamples(ts)
+        
+        if downsamples is None:
+            print(
+                'Stored pyramid levels are unknown for this image, tiles are '
+                'scaled by the tile source.'
+            )
+        else:
+            # Read from the stored level closest at or above the 
+            # magnification, allowing for rounding of the level downsamples,
+            # and resize the rest.
+            downsample = max(
+                (d for d in downsamples if d <= mag_to_fr * 1.01), default=1
+            )
+            level_mag = ts_metadata['magnification'] / downsample
+            
+            if abs(level_mag - mag) > 0.01 * mag:
+                read_mag, resize = level_mag, mag / level_mag
+        
     # Calculate some scale factors.
     if mask is not None:
         # Definitions are when using the scale factor as a multiplicative factor.
         # Full resolution -> mask resolution.
-        fr_to_mask = mask.shape[0] / fr_h
+        if mask_scale is None:
+            fr_to_mask = mask.shape[0] / fr_h
+            mask_shape = mask.shape[:2]
+        else:
+            fr_to_mask = mask_scale
+            mask_shape = (
+                int(fr_h * fr_to_mask), int(ts_metadata['sizeX'] * fr_to_mask)
+            )
         
         mask_tile_size = int(fr_tile_size * fr_to_mask)
-        mask_tile_area = mask_tile_size ** 2
+    else:
+        fr_to_mask = None
     
-    # Calculate the x, y coordinates of the top left of each tile.
-    xys = []
-            
-    for y in range(0, ts_metadata['sizeY'], fr_stride):
-        for x in range(0, ts_metadata['sizeX'], fr_stride):
-            if mask is None:
-                xys.append((x, y, None, None, None))
-            else:
-                # Get the low res mask tile.
-                x1, y1 = int(x * fr_to_mask), int(y * fr_to_mask)
-                                
-                mask_tile = mask[
-                    y1:y1+mask_tile_size, x1:x1+mask_tile_size
-                ]
-                                
-                pos_frac = np.count_nonzero(mask_tile) / mask_tile_area
-                
-                if pos_frac > mask_thr:
-                    xys.append((x, y, x1, y1, pos_frac))
-                        
-    pred_df = []  # track all predictions in dataframe
+    if polygons is not None:
+        if mask is not None:
+            raise ValueError('Give either a mask or polygons, not both.')
+        
+        geometry = polygons_geometry(polygons)
+        rings = geometry_rings(geometry)
+        
+        # Tiles and their exact fraction in the polygons.
+        xys = polygon_tile_coordinates(
+            geometry, ts_metadata['sizeX'], ts_metadata['sizeY'], fr_stride,
+            fr_tile_size, mask_thr=mask_thr
+        )
+    else:
+        rings = None
+        
+        # Calculate the x, y coordinates of the top left of each tile, with 
+        # the top left in the mask and the fraction of the tile in the mask.
+        xys = tile_coordinates(
+            ts_metadata['sizeX'], ts_metadata['sizeY'], fr_stride, 
+            fr_tile_size, mask=mask, fr_to_mask=fr_to_mask, 
+            mask_thr=mask_thr, mask_offset=mask_offset
+        )
     
-    # Predict on tiles in batches.
-    idx = list(range(0, len(xys), batch_size))
+    tile_counts = {'total': len(xys), 'skipped': 0, 'restored': 0}
     
-    print(f'Predicting on tiles for {len(idx)} batches.')
-    for i in tqdm(idx):
-        imgs = []
+    if blank_std_thr is not None or blank_sat_thr is not None:
+        # Reject tiles from statistics on a low resolution read of the image.
+        if ts_metadata['magnification'] is not None:
+            kwargs = dict(scale={'magnification': blank_mag})
+        else:
+            kwargs = dict(output={'maxWidth': 2048, 'maxHeight': 2048})
+            
+        lr_img = ts.getRegion(
+            format=large_image.constants.TILE_FORMAT_NUMPY, frame=frame, 
+            **kwargs
+        )[0]
         
-        batch_xys = xys[i:i+batch_size]
+        _, std, sat = tile_statistics(
+            lr_img, xys[:, 0], xys[:, 1], fr_tile_size, lr_img.shape[0] / fr_h
+        )
         
-        for xy in batch_xys:
-            x, y, tile_x, tile_y, tile_frac = xy
-            
-            img = ts.getRegion(
-                region={
-                    'left': x, 'top': y, 
-                    'right':x + fr_tile_size, 'bottom': y + fr_tile_size
-                },
-                format=large_image.constants.TILE_FORMAT_NUMPY,
-                scale={'magnification': mag},
-                frame=frame
-            )[0]
+        blank = np.zeros(len(xys), dtype=bool)
+        
+        if blank_std_thr is not None:
+            blank |= std < blank_std_thr
             
-            img_shape = img.shape
-                        
-            if img_shape[2] == 1:
-                img = cv.cvtColor(img[:, :, 0], cv.COLOR_GRAY2RGB)
+        if blank_sat_thr is not None:
+            if lr_img.ndim == 3 and lr_img.shape[2] >= 3:
+                blank |= sat < blank_sat_thr
             else:
-                # Convert image to BGR.
-                img = cv.cvtColor(img[:, :, :3], cv.COLOR_RGB2BGR)
-                                                
-            # Pad the image if needed
-            if img_shape[:2] != (tile_size, tile_size):
-                img = cv.copyMakeBorder(
-                    img, 0, tile_size - img_shape[0], 0, 
-                    tile_size - img_shape[1], cv.BORDER_CONSTANT, None, fill
+                # Single channel images have no saturation.
+                print(
+                    'Skipping the saturation check of blank tiles on a single'
+                    ' channel image.'
                 )
-                
-            if mask is not None:
-                if tile_frac < 1:
-                    # Mask out region.
-                    mask_tile = mask[
-                        tile_y:tile_y+mask_tile_size,
-                        tile_x:tile_x+mask_tile_size
-                    ].copy()
-                
-                    # Reshape mask to tile image size.
-                    mask_tile = cv.resize(
-                        mask_tile.copy(), (tile_size, tile_size), 
-                        interpolation=cv.INTER_NEAREST
-                    )
-                    
-                    # Regions outside of mask get set to fill value.
-                    img = img.copy()
-                    
-                    img[mask_tile == 0] = fill
-                
-            imgs.append(img)
             
-        batch_out = model.predict(
-            imgs,
-            device=device,
-            max_det=max_det,
-            iou=iou_thr,
-            conf=conf_thr,
-            imgsz=tile_size,
-            verbose=False,
-            stream=True
+        xys = xys[~blank]
+        tile_counts['skipped'] = int(blank.sum())
+                        
+    # Settings needed to read and predict on tiles, also sent to the shard
+    # processes.
+    settings = dict(
+        frame=frame, read_mag=read_mag, resize=resize, mag_to_fr=mag_to_fr, 
+        fr_tile_size=fr_tile_size, tile_size=tile_size, fill=fill, mask=mask, 
+        mask_tile_size=mask_tile_size if mask is not None else None,
+        mask_offset=tuple(mask_offset), 
+        mask_shape=mask_shape if mask is not None else None, rings=rings,
+        batch_size=batch_size, device=device, max_det=max_det, 
+        iou_thr=iou_thr, conf_thr=conf_thr, workers=workers, 
+        prefetch=prefetch
+    )
+    
+    detections = Detections()  # track all predictions
+    
+    # Parameters that change the raw detections of a tile.
+    params = {
+        'frame': frame, 'mag': mag, 'tile_size': tile_size, 
+        'stride': stride, 'max_det': max_det, 'iou_thr': iou_thr, 
+        'fill': list(fill), 'native_level': native_level,
+        'mask': None if mask is None else \
+            hashlib.sha1(np.ascontiguousarray(mask)).hexdigest(),
+        'mask_offset': list(mask_offset), 'mask_scale': mask_scale,
+        'polygons': None if polygons is None else hashlib.sha1(json.dumps([
+            np.asarray(polygon, dtype=float).tolist() for polygon in polygons
+        ]).encode()).hexdigest()
+    }
+    
+    if cache_dir is not None:
+        # Cache tiles predicted at a low confidence, keyed by the contents of
+        # the image and model weights so any later run with other 
+        # confidence, mask or merge thresholds reuses them.
+        # The key has the confidence the tiles are actually predicted at, a
+        # run with conf_thr below cache_conf caches its tiles separately.
+        pred_conf = min(conf_thr, cache_conf)
+        
+        # The image hash only covers part of the file, the resolved path and
+        # modification time tell apart slides that share it.
+        params.update(
+            fp=file_hash(fp), fp_path=realpath(fp), 
+            fp_mtime=stat(fp).st_mtime_ns, model=model_hash(model), 
+            conf_thr=pred_conf
         )
         
-        for xy, out in zip(batch_xys, batch_out):
-            x, y = xy[:2]
+        directory = join(
+            cache_dir, 
+            hashlib.sha1(
+                json.dumps(params, sort_keys=True).encode()
+            ).hexdigest()
+        )
+        
+        settings['conf_thr'] = pred_conf
+    elif checkpoint is not None:
+        params.update(
+            fp=abspath(fp), 
+            model=model if isinstance(model, str) else \
+                str(getattr(model, 'ckpt_path', None)),
+            conf_thr=conf_thr
+        )
+        
+        directory = checkpoint
+    else:
+        directory = None
+    
+    if directory is not None:
+        store = TileCheckpoint(directory, params, flush_every=checkpoint_every)
+        
+        done_xys, done_counts, done_rows = store.load()
+        
+        # Restore the detections of checkpointed tiles that are still being 
+        # analyzed and skip them.
+        width = ts_metadata['sizeX'] + 1
+        tile_keys = xys[:, 1].astype(int) * width + xys[:, 0].astype(int)
+        done_keys = done_xys[:, 1] * width + done_xys[:, 0]
+        
+        detections.append(
+            done_rows[np.repeat(np.isin(done_keys, tile_keys), done_counts)]
+        )
+        
+        done = np.isin(tile_keys, done_keys)
+        xys = xys[~done]
+        tile_counts['restored'] = int(done.sum())
+        
+        print(
+            f'Restored {len(detections)} predictions of '
+            f'{tile_counts["restored"]} tiles from checkpoint.'
+        )
+    else:
+        store = None
+    
+    if shards > 1:
+        detections.append(_predict_sharded(
+            fp, model, xys, settings, shards, 
+            checkpoint=(store.directory, store.params, checkpoint_every) if \
+                store is not None else None
+        ).data)
+    else:
+        if isinstance(model, str):
+            model = load_yolo(model)
             
-            boxes = out.boxes
-                        
-            for label, box, cf in zip(boxes.cls, boxes.xyxy, boxes.conf):
-                box = box.cpu().detach().numpy()
-                label = label.cpu().detach().numpy()
-                cf = cf.cpu().detach().numpy()
-                
-                # Keep the magnification in mind.
-                x1 = int(box[0] * mag_to_fr) + x
-                y1 = int(box[1] * mag_to_fr) + y
-                x2 = int(box[2] * mag_to_fr) + x
-                y2 = int(box[3] * mag_to_fr) + y
-                        
-                pred_df.append([
-                    int(label), x1, y1, x2, y2, cf,
-                    Polygon([(x1, y1), (x2, y1), (x2, y2), (x1, y2)]), 
-                    (x2-x1)*(y2-y1)
-                ])
-           
-    # Compile boxes into dataframe.     
-    pred_df = GeoDataFrame(
-        pred_df, 
-        columns=['label', 'x1', 'y1', 'x2', 'y2', 'conf', 'geometry', 
-                 'box_area']
-    )
+        detections.append(
+            _predict_tiles(ts, model, xys, settings, store=store).data
+        )
+        
+        if store is not None:
+            store.flush()
         
-    print(f"Merging overlapping boxes from a starting {len(pred_df)} boxes...")
+    if settings['conf_thr'] < conf_thr:
+        # Cached predictions are at a lower confidence.
+        detections = detections.subset(detections['conf'] > conf_thr)
     
-    if len(pred_df):
-        pred_df = non_max_suppression(pred_df, iou_thr)
-        pred_df = remove_contained_boxes(pred_df, contained_thr)
+    tile_counts['processed'] = len(xys)
+    detections.attrs['tiles'] = tile_counts
+    
+    print(
+        f"Skipped {tile_counts['skipped']} blank tiles and predicted on "
+        f"{tile_counts['processed']} of {tile_counts['total']} tiles."
+    )
+    print(
+        f"Merging overlapping boxes from a starting {len(detections)} boxes..."
+    )
+    
+    if len(detections):
+        detections = _merge_predictions(
+            detections, iou_thr, contained_thr, nms_method=nms_method, 
+            agnostic_nms=agnostic_nms, conf_thr=conf_thr
+        )
         
-    print(f'    {len(pred_df)} numbers of predictions returned.')
+    print(f'    {len(detections)} numbers of predictions returned.')
     
-    return pred_df
+    return detections.to_geodataframe() if as_gdf else detections
     
\ No newline at end of file